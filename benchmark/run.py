@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmark.servers import ServiceSimulation, FigmaStandIn, ConfluenceStandIn
+from benchmark.schemas import SchemaGenerator
+
+REPOSITORY_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+OVERVIEW_PAGE_URL_KEYS = [
+    'CONFLUENCE_OVERVIEW_PAGE_URL_STATE_DIAGRAMS',
+    'CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_GRIDS',
+    'CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_DETAILS',
+    'CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_INFO_CARDS',
+    'CONFLUENCE_OVERVIEW_PAGE_URL_MOBILE_LIST',
+    'CONFLUENCE_OVERVIEW_PAGE_URL_MOBILE_DETAILS',
+    'CONFLUENCE_OVERVIEW_PAGE_URL_EMAILS',
+    'CONFLUENCE_OVERVIEW_PAGE_URL_SPOTLIGHT',
+]
+
+
+def write_config(filename, work_folder, figma_server, confluence_server, generator, overrides):
+    """Write a configuration pointing main.py at the stand-in servers, the synthetic schemas and a build folder of its own"""
+
+    config = {
+        'FIGMA_API_TOKEN': 'benchmark',
+        'FIGMA_API_URL': figma_server.base_url,
+        'CONFLUENCE_API_TOKEN': 'benchmark',
+        'CONFLUENCE_API_USERNAME': 'benchmark',
+        'MISSING_FIGMA_PAGE_PLACEHOLDER': '',
+        'CONFLUENCE_BASE_URL': confluence_server.base_url + '/wiki',
+        'CONFLUENCE_SUMMARY_PAGE_URL': generator.get_page_url(90000, 'Summary'),
+        'SCHEMAS_FOLDER': os.path.join(work_folder, 'schemas'),
+        'BUILD_FOLDER': os.path.join(work_folder, 'build'),
+        # the stand-in throttles like Figma would, do not let the client side limit hide it
+        'FIGMA_MAX_REQUESTS_PER_MINUTE': 60000,
+    }
+    for index, key in enumerate(OVERVIEW_PAGE_URL_KEYS):
+        config[key] = generator.get_page_url(90001 + index, key.split('_URL_')[1].title())
+    config.update(overrides)
+
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=4)
+
+
+def run_main(config_filename, main_args, log_filename):
+    """Run main.py end to end in a process of its own, returns (seconds, exit code)"""
+
+    env = dict(os.environ, MPT_OBJECTS_INVENTORY_CONFIG=config_filename)
+    start = time.monotonic()
+    with open(log_filename, 'w', encoding='utf-8') as log:
+        process = subprocess.run(
+            [sys.executable, os.path.join(REPOSITORY_FOLDER, 'main.py')] + main_args,
+            cwd=REPOSITORY_FOLDER,
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT
+        )
+    return time.monotonic() - start, process.returncode
+
+
+def count_requests(server):
+
+    counts = {'requests': 0, 'throttled': 0, 'endpoints': {}}
+    for (endpoint, status), count in sorted(server.requests.items()):
+        counts['requests'] += count
+        if status == 429:
+            counts['throttled'] += count
+        counts['endpoints'][f'{endpoint} {status}'] = count
+    return counts
+
+
+def run_benchmark(object_count, args, main_args):
+    """Generate object_count schemas, start the stand-ins and run main.py args.runs times, returns the results of the runs"""
+
+    work_folder = tempfile.mkdtemp(prefix=f'mpt-benchmark-{object_count}-')
+    figma_server = FigmaStandIn(
+        ServiceSimulation(args.latency, args.jitter, args.figma_rate_limit),
+        args.image_kb * 1024,
+        args.render_ms / 1000
+    ).start()
+    confluence_server = ConfluenceStandIn(
+        ServiceSimulation(args.latency, args.jitter, args.confluence_rate_limit),
+        args.page_kb * 1024
+    ).start()
+
+    results = []
+    try:
+        generator = SchemaGenerator(confluence_server.base_url + '/wiki', args.figma_files, args.fill, args.shared, seed=args.seed)
+        generator.write_schemas(os.path.join(work_folder, 'schemas'), object_count)
+
+        config_filename = os.path.join(work_folder, 'config.json')
+        overrides = dict(override.split('=', 1) for override in args.set)
+        write_config(config_filename, work_folder, figma_server, confluence_server, generator,
+                     {key: json.loads(value) for key, value in overrides.items()})
+
+        for run in range(args.runs):
+            if run > 0:
+                # the first run starts from empty caches, later runs see the edits of a few Figma files
+                for file_key in generator.figma_file_keys[:args.edit_files]:
+                    figma_server.bump_version(file_key)
+
+            figma_server.reset_requests()
+            confluence_server.reset_requests()
+            log_filename = os.path.join(work_folder, f'run-{run + 1}.log')
+            print(f"Running main.py on {object_count} objects (run {run + 1} of {args.runs}), log in {log_filename}...")
+            seconds, exit_code = run_main(config_filename, main_args, log_filename)
+
+            metrics_filename = os.path.join(work_folder, 'build', 'metrics.json')
+            run_metrics = {}
+            if os.path.exists(metrics_filename):
+                with open(metrics_filename, 'r', encoding='utf-8') as f:
+                    run_metrics = json.load(f)
+
+            results.append({
+                'objects': object_count,
+                'run': run + 1,
+                'exit_code': exit_code,
+                'seconds': round(seconds, 3),
+                'objects_per_second': round(object_count / seconds, 2),
+                'phases': run_metrics.get('phases', {}),
+                'bytes': run_metrics.get('bytes', {}),
+                'figma': count_requests(figma_server),
+                'confluence': count_requests(confluence_server),
+            })
+    finally:
+        figma_server.stop()
+        confluence_server.stop()
+        if args.keep:
+            print(f"Kept the schemas, builds and logs in {work_folder}")
+        else:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    return results
+
+
+def print_results(results):
+
+    print()
+    print(f"{'objects':>8} {'run':>4} {'exit':>5} {'seconds':>9} {'objects/s':>10} {'figma':>7} {'conf.':>7} {'429s':>6}  phases (seconds)")
+    for result in results:
+        phases = ', '.join(f"{phase} {phase_metrics['seconds']:.1f}" for phase, phase_metrics in result['phases'].items())
+        throttled = result['figma']['throttled'] + result['confluence']['throttled']
+        print(f"{result['objects']:>8} {result['run']:>4} {result['exit_code']:>5} {result['seconds']:>9.2f} {result['objects_per_second']:>10.2f} "
+              f"{result['figma']['requests']:>7} {result['confluence']['requests']:>7} {throttled:>6}  {phases}")
+
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(
+        description='Run main.py end to end against local Figma and Confluence stand-ins with synthetic schemas. '
+                    'Arguments after -- are passed to main.py.'
+    )
+    parser.add_argument('--objects', type=int, nargs='+', default=[40], metavar='COUNT',
+                        help='numbers of synthetic objects to benchmark (default: 40)')
+    parser.add_argument('--runs', type=int, default=2,
+                        help='runs per object count, the first one starts from empty caches (default: 2)')
+    parser.add_argument('--edit-files', type=int, default=0, metavar='COUNT',
+                        help='Figma files edited before every run but the first (default: 0)')
+    parser.add_argument('--latency', type=float, default=0.05, metavar='SECONDS',
+                        help='latency of every response of both stand-ins (default: 0.05)')
+    parser.add_argument('--jitter', type=float, default=0.02, metavar='SECONDS',
+                        help='random extra latency of every response (default: 0.02)')
+    parser.add_argument('--figma-rate-limit', type=int, default=0, metavar='PER_SECOND',
+                        help='Figma API requests per second before answering 429 (default: no limit)')
+    parser.add_argument('--confluence-rate-limit', type=int, default=0, metavar='PER_SECOND',
+                        help='Confluence requests per second before answering 429 (default: no limit)')
+    parser.add_argument('--render-ms', type=float, default=20, metavar='MS',
+                        help='render time of Figma per requested node (default: 20)')
+    parser.add_argument('--image-kb', type=int, default=200, metavar='KB',
+                        help='size of the rendered images (default: 200)')
+    parser.add_argument('--page-kb', type=int, default=20, metavar='KB',
+                        help='size of the initial body of the Confluence pages (default: 20)')
+    parser.add_argument('--figma-files', type=int, default=8, metavar='COUNT',
+                        help='Figma files the frames of the synthetic schemas are spread over (default: 8)')
+    parser.add_argument('--fill', type=float, default=0.6,
+                        help='share of the views of an object having a Figma link (default: 0.6)')
+    parser.add_argument('--shared', type=float, default=0.1,
+                        help='share of the Figma links pointing at a frame used elsewhere (default: 0.1)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the synthetic schemas (default: 0)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=JSON',
+                        help='override a configuration value, e.g. --set CONFLUENCE_POOL_SIZE=16')
+    parser.add_argument('--output', default=os.path.join(REPOSITORY_FOLDER, 'build', 'benchmark.json'),
+                        help='where to write the results (default: build/benchmark.json)')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the schemas, build folders and logs of the runs')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    main_args = []
+    if '--' in argv:
+        main_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parse_args(argv)
+
+    results = []
+    for object_count in args.objects:
+        results.extend(run_benchmark(object_count, args, main_args))
+
+    print_results(results)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print()
+    print(f"Results written to {args.output}")
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import os
+import json
+import random
+
+
+ROLES = ['vendor', 'operations', 'client']
+
+VIEWS = {
+    'desktop': ['grid', 'details', 'infocard', 'spotlight', 'settings'],
+    'mobile': ['list', 'details'],
+}
+
+
+class SchemaGenerator:
+    """Generates synthetic object schemas shaped like the ones in schemas/.
+
+    Frames are spread over figma_files Figma files, fill is the share of views that have a Figma link,
+    shared is the share of links pointing at a frame already used by another view or object (e.g. a grid
+    shared by vendor and client). The same seed gives the same schemas."""
+
+    def __init__(self, confluence_base_url, figma_files=8, fill=0.6, shared=0.1, max_notifications=6, seed=0):
+        self.confluence_base_url = confluence_base_url
+        self.figma_file_keys = [f'BenchmarkFile{index:03d}' for index in range(figma_files)]
+        self.fill = fill
+        self.shared = shared
+        self.max_notifications = max_notifications
+        self._random = random.Random(seed)
+        self._next_node = 1
+        self._used_links = []
+
+
+    def _figma_link(self):
+
+        if self._used_links and self._random.random() < self.shared:
+            return self._random.choice(self._used_links)
+
+        file_key = self._random.choice(self.figma_file_keys)
+        node_id = f'{self._next_node}-{self._random.randint(1, 99999)}'
+        self._next_node += 1
+        link = f'https://www.figma.com/design/{file_key}/Benchmark?node-id={node_id}&t=benchmark-0'
+        self._used_links.append(link)
+        return link
+
+
+    def _maybe_figma_link(self):
+        return self._figma_link() if self._random.random() < self.fill else None
+
+
+    def get_page_url(self, page_id, title):
+        return f"{self.confluence_base_url}/spaces/bench/pages/{page_id}/{title.replace(' ', '+')}"
+
+
+    def generate_schema(self, index):
+
+        name = f'Object {index:05d}'
+        object_schema = {
+            'name': name,
+            'confluence-page': self.get_page_url(100000 + index, f'DG {name}'),
+            'state-diagram': self._maybe_figma_link(),
+        }
+        for platform, views in VIEWS.items():
+            object_schema[platform] = {
+                view: {role: self._maybe_figma_link() for role in ROLES}
+                for view in views
+            }
+
+        object_schema['email-notifications'] = {
+            role: {
+                f'{name} Notification {number}': self._figma_link()
+                for number in range(1, self._random.randint(0, self.max_notifications) + 1)
+            }
+            for role in ROLES
+        }
+        return object_schema
+
+
+    def write_schemas(self, folder, count):
+        """Write count schema files to folder, returns their filenames"""
+
+        os.makedirs(folder, exist_ok=True)
+        filenames = []
+        for index in range(count):
+            filename = os.path.join(folder, f'object-{index:05d}.json')
+            with open(filename, 'w', encoding='utf-8') as f:
+                json.dump(self.generate_schema(index), f, indent=4)
+            filenames.append(filename)
+        return filenames
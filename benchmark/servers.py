@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+
+import re
+import json
+import time
+import email
+import random
+import hashlib
+import threading
+import collections
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from metrics import get_endpoint
+
+
+class ServiceSimulation:
+    """How a stand-in server behaves: response latency (fixed plus random jitter, in seconds) and throttling,
+    requests over max_requests_per_second (0 for no limit) within one second are answered with 429 and Retry-After"""
+
+    def __init__(self, latency=0.0, jitter=0.0, max_requests_per_second=0, retry_after_seconds=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.max_requests_per_second = max_requests_per_second
+        self.retry_after_seconds = retry_after_seconds
+
+        self._lock = threading.Lock()
+        self._recent_requests = collections.deque()
+
+
+    def delay(self):
+        wait = self.latency + random.uniform(0, self.jitter)
+        if wait > 0:
+            time.sleep(wait)
+
+
+    def is_throttled(self):
+
+        if not self.max_requests_per_second:
+            return False
+
+        with self._lock:
+            now = time.monotonic()
+            while self._recent_requests and self._recent_requests[0] <= now - 1:
+                self._recent_requests.popleft()
+            if len(self._recent_requests) >= self.max_requests_per_second:
+                return True
+            self._recent_requests.append(now)
+            return False
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """Dispatches requests to the handle() method of the stand-in owning the server"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def _handle(self):
+
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        status, headers, payload = self.server.stand_in.handle(self.command, self.path, self.headers, body)
+
+        if isinstance(payload, (dict, list)):
+            payload = json.dumps(payload).encode('utf-8')
+            headers = {'Content-Type': 'application/json', **headers}
+        payload = payload or b''
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PUT = _handle
+    do_DELETE = _handle
+
+
+class StandInServer:
+    """Local HTTP server answering like a remote service, counts the requests it receives by endpoint and status"""
+
+    def __init__(self, simulation=None):
+        self.simulation = simulation or ServiceSimulation()
+        self._server = None
+        self._requests_lock = threading.Lock()
+        self.requests = collections.Counter()
+
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+    def start(self, port=0):
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), _StandInHandler)
+        self._server.daemon_threads = True
+        self._server.stand_in = self
+        threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+    def reset_requests(self):
+        with self._requests_lock:
+            self.requests.clear()
+
+
+    def handle(self, method, path, headers, body):
+
+        if self.is_throttled(path) and self.simulation.is_throttled():
+            status, response_headers, payload = 429, {'Retry-After': str(self.simulation.retry_after_seconds)}, None
+        else:
+            self.simulation.delay()
+            status, response_headers, payload = self.respond(method, urlparse(path), headers, body)
+
+        with self._requests_lock:
+            self.requests[(get_endpoint(method, path), status)] += 1
+        return status, response_headers, payload
+
+
+    def is_throttled(self, path):
+        """Whether the throttling of the simulation applies to a path"""
+        return True
+
+
+    def respond(self, method, url, headers, body):
+        raise NotImplementedError
+
+
+class FigmaStandIn(StandInServer):
+    """Figma REST API (file versions, image renders) and image CDN.
+
+    Rendered images are image_bytes long and the same for the same file version and node, bump_version()
+    simulates an edit of a Figma file. Render requests take render_seconds_per_node more per requested node."""
+
+    def __init__(self, simulation=None, image_bytes=200 * 1024, render_seconds_per_node=0.0):
+        super().__init__(simulation)
+        self.image_bytes = image_bytes
+        self.render_seconds_per_node = render_seconds_per_node
+        self._file_versions = {}
+        # opaque ids of the rendered images, like the CDN URLs Figma returns
+        self._images = {}
+
+
+    def bump_version(self, file_key):
+        self._file_versions[file_key] = self._file_versions.get(file_key, 1) + 1
+
+
+    def is_throttled(self, path):
+        # the CDN serving the images is not rate limited, the API is
+        return path.startswith('/v1/')
+
+
+    def _get_image(self, file_key, node_id):
+
+        seed = f'{file_key}|{node_id}|{self._file_versions.get(file_key, 1)}'.encode('utf-8')
+        block = hashlib.sha256(seed).digest()
+        payload = b'\x89PNG\r\n\x1a\n' + block * (self.image_bytes // len(block) + 1)
+        return payload[:max(self.image_bytes, 8)]
+
+
+    def respond(self, method, url, headers, body):
+
+        match = re.match(r'^/v1/files/([A-Za-z0-9]+)$', url.path)
+        if match:
+            return 200, {}, {'version': str(self._file_versions.get(match.group(1), 1))}
+
+        match = re.match(r'^/v1/images/([A-Za-z0-9]+)$', url.path)
+        if match:
+            file_key = match.group(1)
+            node_ids = parse_qs(url.query).get('ids', [''])[0].split(',')
+            if self.render_seconds_per_node:
+                time.sleep(self.render_seconds_per_node * len(node_ids))
+            images = {}
+            for node_id in node_ids:
+                node_key = node_id.replace('-', ':')
+                image_id = hashlib.sha256(f'{file_key}|{node_key}'.encode('utf-8')).hexdigest()[:32]
+                self._images[image_id] = (file_key, node_key)
+                images[node_key] = f'{self.base_url}/images/{image_id}'
+            return 200, {}, {'err': None, 'images': images}
+
+        match = re.match(r'^/images/([0-9a-f]+)$', url.path)
+        if match and match.group(1) in self._images:
+            return 200, {'Content-Type': 'image/png'}, self._get_image(*self._images[match.group(1)])
+
+        return 404, {}, {'status': 404, 'err': 'Not found'}
+
+
+class ConfluenceStandIn(StandInServer):
+    """The Confluence REST endpoints used by confluence.py: pages, CQL search by id, attachments and page properties.
+
+    Every page id exists, a page starts with a body of page_bytes characters. The base URL of the API is base_url + '/wiki'."""
+
+    def __init__(self, simulation=None, page_bytes=20 * 1024):
+        super().__init__(simulation)
+        self.page_bytes = page_bytes
+        self._lock = threading.Lock()
+        self._next_id = 1000
+        self._pages = {}
+        self._attachments = {}
+        self._properties = {}
+
+
+    def _new_id(self):
+        self._next_id += 1
+        return str(self._next_id)
+
+
+    def _get_page(self, page_id):
+
+        if page_id not in self._pages:
+            self._pages[page_id] = {
+                'id': page_id,
+                'type': 'page',
+                'title': f'Page {page_id}',
+                'version': {'number': 1},
+                'body': {'storage': {'value': '<p>' + 'x' * self.page_bytes + '</p>'}},
+            }
+        return self._pages[page_id]
+
+
+    def _page_response(self, page_id, expand):
+
+        page = dict(self._get_page(page_id))
+        if 'body.storage' not in expand:
+            del page['body']
+        page['metadata'] = {'properties': {
+            page_property['key']: page_property for page_property in self._properties.get(page_id, {}).values()
+        }}
+        return page
+
+
+    def _parse_files(self, headers, body):
+        # Returns the (filename, content) file parts and the comment parts of a multipart request
+
+        message = email.message_from_bytes(
+            f"Content-Type: {headers['Content-Type']}\r\n\r\n".encode('utf-8') + body,
+            policy=HTTP
+        )
+        files = []
+        comments = []
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if name == 'file':
+                files.append((part.get_filename(), part.get_payload(decode=True)))
+            elif name == 'comment':
+                comments.append(part.get_content().strip())
+        return files, comments
+
+
+    def _respond_attachments(self, method, page_id, query, headers, body):
+
+        attachments = self._attachments.setdefault(page_id, {})
+        if method == 'GET':
+            results = [
+                attachment for attachment in attachments.values()
+                if 'filename' not in query or attachment['title'] == query['filename'][0]
+            ]
+            start = int(query.get('start', ['0'])[0])
+            limit = int(query.get('limit', ['25'])[0])
+            links = {}
+            if start + limit < len(results):
+                links['next'] = f'/rest/api/content/{page_id}/child/attachment?limit={limit}&start={start + limit}&expand=version,metadata'
+            return 200, {}, {'results': results[start:start + limit], '_links': links}
+
+        files, comments = self._parse_files(headers, body)
+        created_attachments = []
+        for index, (filename, content) in enumerate(files):
+            if any(attachment['title'] == filename for attachment in attachments.values()):
+                return 400, {}, {'message': f'Cannot add a new attachment with same file name as an existing attachment: {filename}'}
+            attachment = {
+                'id': self._new_id(),
+                'type': 'attachment',
+                'status': 'current',
+                'title': filename,
+                'version': {'number': 1},
+                'metadata': {'comment': comments[index] if index < len(comments) else ''},
+                'extensions': {'fileSize': len(content)},
+            }
+            attachments[attachment['id']] = attachment
+            created_attachments.append(attachment)
+        return 200, {}, {'results': created_attachments}
+
+
+    def _respond_content(self, method, content_id, query, body):
+
+        for attachments in self._attachments.values():
+            if content_id in attachments:
+                if method != 'DELETE':
+                    return 405, {}, None
+                attachment = attachments[content_id]
+                status = query.get('status', ['current'])[0]
+                if attachment['status'] != status:
+                    return 404, {}, None
+                if status == 'current':
+                    attachment['status'] = 'trashed'
+                else:
+                    del attachments[content_id]
+                return 204, {}, None
+
+        if method == 'GET':
+            return 200, {}, self._page_response(content_id, query.get('expand', [''])[0])
+
+        if method == 'PUT':
+            page = self._get_page(content_id)
+            data = json.loads(body)
+            if data['version']['number'] != page['version']['number'] + 1:
+                return 409, {}, {'message': 'Version must be incremented on update'}
+            page['version'] = {'number': data['version']['number']}
+            page['title'] = data['title']
+            page['body'] = {'storage': {'value': data['body']['storage']['value']}}
+            return 200, {}, page
+
+        return 405, {}, None
+
+
+    def _respond_properties(self, method, page_id, property_id, body):
+
+        properties = self._properties.setdefault(page_id, {})
+        if method == 'GET':
+            return 200, {}, {'results': list(properties.values()), '_links': {}}
+        if method == 'POST':
+            page_property = json.loads(body)
+            page_property['id'] = self._new_id()
+            page_property['version'] = {'number': 1}
+            properties[page_property['id']] = page_property
+            return 200, {}, page_property
+        if property_id not in properties:
+            return 404, {}, None
+        if method == 'PUT':
+            data = json.loads(body)
+            properties[property_id].update(value=data['value'], version={'number': data['version']['number']})
+            return 200, {}, properties[property_id]
+        del properties[property_id]
+        return 204, {}, None
+
+
+    def respond(self, method, url, headers, body):
+
+        path = url.path[len('/wiki'):] if url.path.startswith('/wiki/') else url.path
+        query = parse_qs(url.query)
+
+        with self._lock:
+            match = re.match(r'^/rest/api/content/(\d+)/child/attachment$', path)
+            if match:
+                return self._respond_attachments(method, match.group(1), query, headers, body)
+
+            if path == '/rest/api/content/search':
+                page_ids = re.findall(r'\d+', query.get('cql', [''])[0])
+                expand = query.get('expand', [''])[0]
+                return 200, {}, {'results': [self._page_response(page_id, expand) for page_id in page_ids], '_links': {}}
+
+            match = re.match(r'^/rest/api/content/(\d+)$', path)
+            if match:
+                return self._respond_content(method, match.group(1), query, body)
+
+            match = re.match(r'^/api/v2/pages/(\d+)/properties(?:/(\d+))?$', path)
+            if match:
+                return self._respond_properties(method, match.group(1), match.group(2), body)
+
+        return 404, {}, {'statusCode': 404, 'message': f'No endpoint {method} {path}'}
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import re
+import hashlib
+import threading
+from html.parser import HTMLParser
+
+from tracing import tracer
+from util import create_process_pool
+
+
+# Attributes Confluence maintains on its own, they carry no data of ours
+NONDATA_ATTRIBUTES = ('ri:version-at-save',)
+
+# Whitespace HTML collapses; U+00A0 (&nbsp;) is text, a page with a non-breaking space differs from one without
+ASCII_WHITESPACE_PATTERN = re.compile(r'[ \t\n\r\f]+')
+
+# Elements without an end tag, <col> and <col/> are the same element
+VOID_ELEMENTS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'])
+
+
+class _CanonicalDigestParser(HTMLParser):
+    """Streams Confluence storage format into a SHA-256 of its canonical form.
+
+    The canonical form ignores attribute order, non-data attributes, ASCII whitespace between and around
+    text, and the difference between <x/> and <x></x>. Tag and attribute names are lower case.
+    Like a tree builder, stray end tags are dropped and unclosed elements are closed implicitly."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._digest = hashlib.sha256()
+        self._text = []
+        self._open_tags = []
+
+
+    def _flush_text(self):
+        if self._text:
+            text = ASCII_WHITESPACE_PATTERN.sub(' ', ''.join(self._text)).strip(' ')
+            self._text = []
+            if text:
+                self._digest.update(b'T' + text.encode('utf-8') + b'\0')
+
+
+    def _emit(self, kind, token):
+        self._flush_text()
+        self._digest.update(kind + token.encode('utf-8') + b'\0')
+
+
+    def handle_starttag(self, tag, attrs):
+        canonical_attrs = sorted((name, value or '') for name, value in attrs if name not in NONDATA_ATTRIBUTES)
+        self._emit(b'S', tag + ''.join(f'\1{name}\2{value}' for name, value in canonical_attrs))
+        if tag in VOID_ELEMENTS:
+            self._emit(b'E', tag)
+        else:
+            self._open_tags.append(tag)
+
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+
+    def handle_endtag(self, tag):
+        if tag not in self._open_tags:
+            return
+        while True:
+            open_tag = self._open_tags.pop()
+            self._emit(b'E', open_tag)
+            if open_tag == tag:
+                break
+
+
+    def handle_data(self, data):
+        self._text.append(data)
+
+
+    def handle_comment(self, data):
+        self._emit(b'C', data)
+
+
+    def handle_decl(self, decl):
+        self._emit(b'D', decl)
+
+
+    def unknown_decl(self, data):
+        # CDATA sections (e.g. code macro bodies) are kept verbatim
+        self._emit(b'U', data)
+
+
+    def handle_pi(self, data):
+        self._emit(b'P', data)
+
+
+    def hexdigest(self):
+        self.close()
+        while self._open_tags:
+            self._emit(b'E', self._open_tags.pop())
+        self._flush_text()
+        return self._digest.hexdigest()
+
+
+def canonical_digest(html):
+    """Return a stable digest of Confluence storage format HTML, equal for equivalent markup"""
+
+    parser = _CanonicalDigestParser()
+    parser.feed(html)
+    return parser.hexdigest()
+
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def _get_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = create_process_pool()
+    return _process_pool
+
+
+@tracer.traced('canonical')
+def canonical_digests(htmls, process_pool_min_size):
+    """Return the canonical digests of several HTML documents.
+
+    Documents of at least process_pool_min_size characters are digested in a process pool, so big pages
+    do not hold the GIL for the other threads, smaller ones are digested right away."""
+
+    futures = {}
+    for index, html in enumerate(htmls):
+        if len(html) >= process_pool_min_size:
+            futures[index] = _get_process_pool().submit(canonical_digest, html)
+
+    return [futures[index].result() if index in futures else canonical_digest(html) for index, html in enumerate(htmls)]
@@ -2,7 +2,7 @@
 
 import os
 import json
-from requests.auth import HTTPBasicAuth
+import threading
 
 #
 # Expected configuration JSON file:
@@ -12,18 +12,68 @@ from requests.auth import HTTPBasicAuth
 #    "API_TOKEN": "{token goes here}"
 # }
 #
+# Another file can be used by setting MPT_OBJECTS_INVENTORY_CONFIG to its path (see benchmark/run.py)
+#
+# Modules use the shared cfg below, the file is only read (and validated) when a value is first needed.
+#
+
+# Values that must be in the configuration file
+REQUIRED_KEYS = [
+    'FIGMA_API_TOKEN',
+    'CONFLUENCE_API_TOKEN',
+    'CONFLUENCE_API_USERNAME',
+    'MISSING_FIGMA_PAGE_PLACEHOLDER',
+    'CONFLUENCE_BASE_URL',
+    'CONFLUENCE_SUMMARY_PAGE_URL',
+    'CONFLUENCE_OVERVIEW_PAGE_URL_STATE_DIAGRAMS',
+    'CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_GRIDS',
+    'CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_DETAILS',
+    'CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_INFO_CARDS',
+    'CONFLUENCE_OVERVIEW_PAGE_URL_MOBILE_LIST',
+    'CONFLUENCE_OVERVIEW_PAGE_URL_MOBILE_DETAILS',
+    'CONFLUENCE_OVERVIEW_PAGE_URL_EMAILS',
+    'CONFLUENCE_OVERVIEW_PAGE_URL_SPOTLIGHT',
+]
+
+# Optional values that must be positive numbers when given
+POSITIVE_NUMBER_KEYS = [
+    'CONFLUENCE_LATENCY_TARGET_SECONDS',
+    'RENDER_CACHE_MAX_MB',
+    'FIGMA_MAX_REQUESTS_PER_MINUTE',
+    'FIGMA_MAX_RETRY_WAIT_SECONDS',
+]
+
+# Optional counts (connections, threads, processes, ...) that must be whole numbers, 1 or more, when given
+POSITIVE_COUNT_KEYS = [
+    'CONFLUENCE_POOL_SIZE',
+    'CONFLUENCE_INITIAL_CONCURRENCY',
+    'CANONICAL_PROCESS_POOL_MIN_SIZE',
+    'MAX_THREADS',
+    'CONFLUENCE_ATTACHMENTS_PER_REQUEST',
+    'FIGMA_MAX_CONCURRENT_REQUESTS',
+    'FIGMA_MAX_CONCURRENT_DOWNLOADS',
+    'SCHEMA_LOADER_PROCESSES',
+]
+
+# Optional values that must be whole numbers, 0 or more, when given
+RETRY_COUNT_KEYS = [
+    'CONFLUENCE_MAX_RETRIES',
+    'FIGMA_MAX_RETRIES',
+]
+
 
 class Config:
 
     def __init__(self):
 
-        configFileName = os.path.expanduser('~/.mpt-objects-inventory-config.json')
+        configFileName = os.path.expanduser(os.environ.get('MPT_OBJECTS_INVENTORY_CONFIG', '~/.mpt-objects-inventory-config.json'))
 
         print(f'loading configuration from: {configFileName}...')
         f = open(configFileName, 'r')
         txt = f.read()
         f.close()
         data = json.loads(txt)
+        self._validate(configFileName, data)
 
         # Debug flags
         self.SKIP_UPDATE_CONFLUENCE_PAGE_FOR_DEBUG = False
@@ -34,6 +84,8 @@ class Config:
         # Token name: mpt-objects-inventory-token-{date}
         self.FIGMA_API_TOKEN = data['FIGMA_API_TOKEN']
 
+        self.FIGMA_API_URL = data.get('FIGMA_API_URL', 'https://api.figma.com')
+
         # Token name: mpt-objects-inventory-token-{date}
         self.CONFLUENCE_API_TOKEN = data['CONFLUENCE_API_TOKEN']
     
@@ -43,11 +95,56 @@ class Config:
 
         self.CONFLUENCE_BASE_URL = data['CONFLUENCE_BASE_URL']
 
-        self.CONFLUENCE_AUTH = HTTPBasicAuth(self.CONFLUENCE_API_USERNAME, self.CONFLUENCE_API_TOKEN)
+        # requests sends a (username, password) tuple as basic authentication
+        self.CONFLUENCE_AUTH = (self.CONFLUENCE_API_USERNAME, self.CONFLUENCE_API_TOKEN)
+
+        # Connections kept open to Confluence (also the maximum of concurrent requests) and retries of transient errors
+        self.CONFLUENCE_POOL_SIZE = data.get('CONFLUENCE_POOL_SIZE', 8)
+        self.CONFLUENCE_MAX_RETRIES = data.get('CONFLUENCE_MAX_RETRIES', 5)
+
+        # Concurrent Confluence requests start at this limit and adapt between 1 and CONFLUENCE_POOL_SIZE:
+        # the limit grows while responses are faster than the target and not throttled, and is halved on 429/503
+        self.CONFLUENCE_INITIAL_CONCURRENCY = data.get('CONFLUENCE_INITIAL_CONCURRENCY', 2)
+        self.CONFLUENCE_LATENCY_TARGET_SECONDS = data.get('CONFLUENCE_LATENCY_TARGET_SECONDS', 2.0)
+
+        # Pages at least this long (in characters) are canonicalized in a process pool for change detection
+        self.CANONICAL_PROCESS_POOL_MIN_SIZE = data.get('CANONICAL_PROCESS_POOL_MIN_SIZE', 2 * 1024 * 1024)
+
+        # Worker threads used by main.py for the Confluence phases, the adaptive limit decides how many requests are in flight
+        self.MAX_THREADS = data.get('MAX_THREADS', self.CONFLUENCE_POOL_SIZE)
+
+        # Number of images sent as file parts of one attachment upload request
+        self.CONFLUENCE_ATTACHMENTS_PER_REQUEST = data.get('CONFLUENCE_ATTACHMENTS_PER_REQUEST', 10)
 
         self.CONFLUENCE_SUMMARY_PAGE_URL = data['CONFLUENCE_SUMMARY_PAGE_URL']
 
-        self.TEMP_RENDER_FOLDER = os.path.join(os.path.dirname(__file__), 'build')
+        self.SCHEMAS_FOLDER = data.get('SCHEMAS_FOLDER', os.path.join(os.path.dirname(__file__), 'schemas'))
+
+        # Processes parsing and validating the schema files that changed since the last run (when there are many of them)
+        self.SCHEMA_LOADER_PROCESSES = data.get('SCHEMA_LOADER_PROCESSES', os.cpu_count() or 1)
+
+        self.TEMP_RENDER_FOLDER = data.get('BUILD_FOLDER', os.path.join(os.path.dirname(__file__), 'build'))
+
+        # Persistent state that survives between runs (see run.sh)
+        self.CACHE_FOLDER = os.path.join(self.TEMP_RENDER_FOLDER, 'cache')
+
+        # Optional extra copy of the Prometheus metrics of every run, e.g. in the directory of the node exporter textfile collector
+        self.METRICS_TEXTFILE = data.get('METRICS_TEXTFILE')
+
+        # Only re-render and republish objects whose schema file or templates changed since the last run
+        self.INCREMENTAL = data.get('INCREMENTAL', False)
+
+        # Rendered Figma images are kept until the cache grows over this size
+        self.RENDER_CACHE_MAX_BYTES = data.get('RENDER_CACHE_MAX_MB', 2048) * 1024 * 1024
+
+        # Figma requests in flight at the same time: API calls (versions, render requests) and image downloads
+        self.FIGMA_MAX_CONCURRENT_REQUESTS = data.get('FIGMA_MAX_CONCURRENT_REQUESTS', 4)
+        self.FIGMA_MAX_CONCURRENT_DOWNLOADS = data.get('FIGMA_MAX_CONCURRENT_DOWNLOADS', 8)
+
+        # Figma API rate limiting: requests are spread out to stay below this rate, throttled requests are retried
+        self.FIGMA_MAX_REQUESTS_PER_MINUTE = data.get('FIGMA_MAX_REQUESTS_PER_MINUTE', 120)
+        self.FIGMA_MAX_RETRIES = data.get('FIGMA_MAX_RETRIES', 5)
+        self.FIGMA_MAX_RETRY_WAIT_SECONDS = data.get('FIGMA_MAX_RETRY_WAIT_SECONDS', 300)
 
         self.CONFLUENCE_OVERVIEW_PAGE_URL_STATE_DIAGRAMS = data['CONFLUENCE_OVERVIEW_PAGE_URL_STATE_DIAGRAMS']
         self.CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_GRIDS = data['CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_GRIDS']
@@ -56,4 +153,65 @@ class Config:
         self.CONFLUENCE_OVERVIEW_PAGE_URL_MOBILE_LIST = data['CONFLUENCE_OVERVIEW_PAGE_URL_MOBILE_LIST']
         self.CONFLUENCE_OVERVIEW_PAGE_URL_MOBILE_DETAILS = data['CONFLUENCE_OVERVIEW_PAGE_URL_MOBILE_DETAILS']
         self.CONFLUENCE_OVERVIEW_PAGE_URL_EMAILS = data['CONFLUENCE_OVERVIEW_PAGE_URL_EMAILS']
-        self.CONFLUENCE_OVERVIEW_PAGE_URL_SPOTLIGHT = data['CONFLUENCE_OVERVIEW_PAGE_URL_SPOTLIGHT']
\ No newline at end of file
+        self.CONFLUENCE_OVERVIEW_PAGE_URL_SPOTLIGHT = data['CONFLUENCE_OVERVIEW_PAGE_URL_SPOTLIGHT']
+
+    def _validate(self, config_filename, data):
+        """Raise a ValueError listing every problem of the configuration file at once"""
+
+        problems = []
+        if not isinstance(data, dict):
+            problems.append('the file must hold a JSON object')
+            data = {}
+
+        for key in REQUIRED_KEYS:
+            if not isinstance(data.get(key), str):
+                problems.append(f'{key} is missing or not a string')
+
+        for key in ['CONFLUENCE_BASE_URL', 'FIGMA_API_URL']:
+            if isinstance(data.get(key), str) and not data[key].startswith(('https://', 'http://')):
+                problems.append(f'{key} must be an http(s) URL')
+
+        for key in REQUIRED_KEYS:
+            if key.endswith('_PAGE_URL') or '_PAGE_URL_' in key:
+                if isinstance(data.get(key), str) and '/pages/' not in data[key]:
+                    problems.append(f'{key} must be the URL of a Confluence page (.../pages/<id>/...)')
+
+        for key in POSITIVE_NUMBER_KEYS:
+            if key in data and (isinstance(data[key], bool) or not isinstance(data[key], (int, float)) or data[key] <= 0):
+                problems.append(f'{key} must be a positive number')
+        for key in POSITIVE_COUNT_KEYS:
+            if key in data and (isinstance(data[key], bool) or not isinstance(data[key], int) or data[key] <= 0):
+                problems.append(f'{key} must be a whole number, 1 or more')
+        for key in RETRY_COUNT_KEYS:
+            if key in data and (isinstance(data[key], bool) or not isinstance(data[key], int) or data[key] < 0):
+                problems.append(f'{key} must be a whole number, 0 or more')
+
+        if problems:
+            raise ValueError(f'Invalid configuration in {config_filename}:\n  ' + '\n  '.join(problems))
+
+
+class _LazyConfig:
+    """Stands for the Config of the process, which is built (the file read and validated) on first use"""
+
+    def __init__(self):
+        self._config = None
+        self._lock = threading.Lock()
+
+
+    def _get_config(self):
+
+        with self._lock:
+            if self._config is None:
+                self._config = Config()
+            return self._config
+
+
+    def __getattr__(self, name):
+        # only called for attributes that are not set on the proxy itself
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._get_config(), name)
+
+
+# The configuration shared by all modules
+cfg = _LazyConfig()
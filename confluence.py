@@ -1,23 +1,121 @@
 #!/usr/bin/env python
 
 import re
-import requests
 import json
 import os
+import contextlib
+import hashlib
+import threading
 import concurrent.futures
-from bs4 import BeautifulSoup
 
-from config import Config
+from config import cfg
+from util import file_sha256
+from throttling import AdaptiveConcurrencyLimit
+from canonical import canonical_digests
+from ledger import PublishLedger
+from metrics import metrics
+from tracing import tracer
 
-cfg = Config()
 
+# Attachments uploaded by this tool carry the SHA-256 of their content in the attachment comment
+ATTACHMENT_CHECKSUM_COMMENT_PREFIX = 'sha256:'
 
 
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+# Run-scoped page metadata shared by all Confluence instances: page id -> {id, title, version, body, body_hash, appearance_property}
+# (and canonical_digest, once it has been computed)
+_page_cache = {}
+_page_cache_lock = threading.Lock()
+
+# Content property holding the published appearance of a page
+PAGE_APPEARANCE_PROPERTY_KEY = 'content-appearance-published'
+PAGE_APPEARANCE_FULL_WIDTH = 'full-width'
+
+# Expansions used whenever a page is read, so that the cache holds everything we need about a page,
+# the body is left out when only the metadata is needed
+PAGE_METADATA_EXPAND = f'version,metadata.properties.{PAGE_APPEARANCE_PROPERTY_KEY}'
+PAGE_EXPAND = f'body.storage,{PAGE_METADATA_EXPAND}'
+
+# Number of pages fetched with one CQL search when prefetching page metadata
+CONFLUENCE_PAGES_PER_SEARCH = 25
+
+# What we published to each page in previous runs, shared by all Confluence instances, see get_ledger
+_ledger = None
+_ledger_lock = threading.Lock()
+
+# Shared by all Confluence phases, so they all back off together when Confluence throttles us
+_concurrency_limit = None
+_concurrency_limit_lock = threading.Lock()
+
+
+def get_ledger():
+    """Return the publish ledger shared by all Confluence instances, created on first use as it needs the configuration"""
+
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = PublishLedger(os.path.join(cfg.CACHE_FOLDER, 'publish-ledger.sqlite'))
+    return _ledger
+
+
+def _get_concurrency_limit():
+
+    global _concurrency_limit
+    with _concurrency_limit_lock:
+        if _concurrency_limit is None:
+            _concurrency_limit = AdaptiveConcurrencyLimit(
+                cfg.CONFLUENCE_INITIAL_CONCURRENCY,
+                cfg.CONFLUENCE_POOL_SIZE,
+                cfg.CONFLUENCE_LATENCY_TARGET_SECONDS
+            )
+    return _concurrency_limit
+
+
+def _get_shared_session():
+    """Return the session shared by all Confluence instances (one connection pool, retry policy and connection cap).
+
+    It is created on the first request, so requests is not even imported by runs that never ask Confluence (e.g. --plan)."""
+
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            from confluence_session import create_session
+            session = create_session(_get_concurrency_limit(), cfg.CONFLUENCE_POOL_SIZE, cfg.CONFLUENCE_MAX_RETRIES)
+            metrics.instrument_session(session, 'confluence')
+            tracer.instrument_session(session, 'confluence')
+            _shared_session = session
+    return _shared_session
+
+
+# trivial helpers are left out, they would only clutter the trace
+@tracer.traced_methods('confluence', exclude=('get_request_stats', 'set_use_publish_ledger', 'get_confluence_page_id_from_url', 'get_cached_page_metadata'))
 class Confluence:
+    """Confluence REST client, safe to use from several threads at once"""
+
+    @property
+    def _session(self):
+        return _get_shared_session()
+
+
+    def get_request_stats(self):
+        concurrency_limit = _get_concurrency_limit()
+        return {
+            'requests': concurrency_limit.request_count,
+            'throttled': concurrency_limit.throttled_count,
+            'concurrency_limit': int(concurrency_limit.limit),
+        }
+
+
+    def set_use_publish_ledger(self, enabled):
+        """Whether to trust the publish ledger, shared by all instances"""
+        get_ledger().enabled = enabled
+
 
     def delete_confluence_attachment(self, attachment_id, status):
         delete_url = f"{cfg.CONFLUENCE_BASE_URL}/rest/api/content/{attachment_id}?status={status}"
-        delete_response = requests.delete(
+        delete_response = self._session.delete(
             delete_url,
             headers={"Accept": "application/json"},
             auth=cfg.CONFLUENCE_AUTH
@@ -30,136 +128,242 @@ class Confluence:
 
 
     def make_page_full_width(self, page_url):
+        """Set the appearance property of a page to full width, only writes if it has another value, returns True if it did"""
 
         page_id = self.get_confluence_page_id_from_url(page_url)
-        property_key = "content-appearance-published"
         properties_base_url = f"{cfg.CONFLUENCE_BASE_URL}/api/v2/pages/{page_id}/properties"
 
-        payload = {
-            "key": property_key,
-            "value": "full-width"
-        }
+        # The appearance property is read together with the page metadata
+        full_width_property = self.get_page_metadata(page_url)['appearance_property']
+        if full_width_property is not None and full_width_property.get('value') == PAGE_APPEARANCE_FULL_WIDTH:
+            return False
 
-        # Get all properties of the page first
-        properties_response = requests.get(
-            properties_base_url,
-            headers={
-                "Accept": "application/json"
-            },
-            auth=cfg.CONFLUENCE_AUTH
-        )
-        properties_response.raise_for_status()
-
-        properties = properties_response.json()
-        full_width_property = None
-        for property in properties.get('results', []):
-            _key = property['key']
-            if _key == property_key:
-                full_width_property = property
-                break
-
-        if full_width_property:
-            # delete if existing
-            response = requests.delete(
+        if full_width_property is not None:
+            # update the existing property in place
+            response = self._session.put(
                 f"{properties_base_url}/{full_width_property['id']}",
                 headers={
-                    "Accept": "application/json"
+                    "Accept": "application/json",
+                    "Content-Type": "application/json"
                 },
-                auth=cfg.CONFLUENCE_AUTH
+                auth=cfg.CONFLUENCE_AUTH,
+                json={
+                    "key": PAGE_APPEARANCE_PROPERTY_KEY,
+                    "value": PAGE_APPEARANCE_FULL_WIDTH,
+                    "version": {
+                        "number": full_width_property['version']['number'] + 1
+                    }
+                }
+            )
+        else:
+            response = self._session.post(
+                properties_base_url,
+                headers={
+                    "Accept": "application/json",
+                    "Content-Type": "application/json"
+                },
+                auth=cfg.CONFLUENCE_AUTH,
+                json={
+                    "key": PAGE_APPEARANCE_PROPERTY_KEY,
+                    "value": PAGE_APPEARANCE_FULL_WIDTH
+                }
             )
-            response.raise_for_status()
-
-        # Now force create the property with the correct value
-        response = requests.post(
-            properties_base_url,
-            headers={
-                "Accept": "application/json",
-                "Content-Type": "application/json"
-            },
-            auth=cfg.CONFLUENCE_AUTH,
-            json=payload
-        )
 
         response.raise_for_status()
 
+        with _page_cache_lock:
+            _page_cache[page_id]['appearance_property'] = response.json()
+        return True
 
-    def upload_image_to_confluence(self, page_url, image_path):
 
-        page_id = self.get_confluence_page_id_from_url(page_url)
+    def make_pages_full_width(self, page_urls):
+        """Make many pages full width in one pass, page metadata is prefetched in bulk first"""
 
-        # See: https://support.atlassian.com/confluence/kb/using-the-confluence-rest-api-to-upload-an-attachment-to-one-or-more-pages/
-        request_url = f'{cfg.CONFLUENCE_BASE_URL}/rest/api/content/{page_id}/child/attachment'
-        print(f"Uploading image version to Confluence: {image_path}")
+        self.prefetch_pages(page_urls)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=cfg.CONFLUENCE_POOL_SIZE) as executor:
+            changed = sum(executor.map(self.make_page_full_width, page_urls))
+        print(f"Made {changed} of {len(page_urls)} pages full width, the others already were")
+        return changed
 
-        filename = os.path.basename(image_path)
 
-        with open(image_path, 'rb') as file_handle:
-            files = {
-                'file': (filename, file_handle, 'image/png')
-            }
-            data = {
-                "minorEdit": "true"
-            }
+    def upload_image_to_confluence(self, page_url, image_path, existing_attachments=None):
 
-            # First try to update the existing attachment version; if it does not exist, fall back to upload a new one
-            # See: https://developer.atlassian.com/cloud/confluence/rest/v1/api-group-attachments/#api-wiki-rest-api-content-id-child-attachment-put
-            # We'll first check if an attachment with the filename exists, and if so, update it; otherwise, create new.
-
-            # First, check if the attachment already exists by filename
-            get_params = {
-                "filename": filename,
-                "expand": "version"
-            }
-            check_response = requests.get(
-                request_url,
+        if existing_attachments is None:
+            # Only check for an attachment with this filename, no need to list all attachments of the page
+            page_id = self.get_confluence_page_id_from_url(page_url)
+            check_response = self._session.get(
+                f'{cfg.CONFLUENCE_BASE_URL}/rest/api/content/{page_id}/child/attachment',
                 headers={"Accept": "application/json"},
                 auth=cfg.CONFLUENCE_AUTH,
-                params=get_params
+                params={
+                    "filename": os.path.basename(image_path),
+                    "expand": "version"
+                }
             )
             check_response.raise_for_status()
-            attachment_result = check_response.json()
-            results = attachment_result.get("results", [])
-
-            if results:
-                # Attachment exists, delete the existing attachment and upload a new one
-                attachment_id = results[0]["id"]
-                print(f"Deleting existing attachment with id: {attachment_id}")
-                self.delete_confluence_attachment(attachment_id, "current")
-                self.delete_confluence_attachment(attachment_id, "trashed")
-
-            response = requests.post(
-                request_url,
-                headers={
-                    "Accept": "application/json",
-                    "X-Atlassian-Token": "no-check"
-                },
-                auth=cfg.CONFLUENCE_AUTH,
-                files=files,
-                data=data
-            )
+            existing_attachments = {attachment['title']: attachment for attachment in check_response.json().get("results", [])}
+
+        return self.upload_images_to_confluence(page_url, {image_path: None}, existing_attachments)[0]
+
+
+    def upload_images_to_confluence(self, page_url, image_checksums, existing_attachments=None):
+        """Upload images to a page, dict image_path -> SHA-256 (or None if unknown), returns the created attachments.
+
+        Up to CONFLUENCE_ATTACHMENTS_PER_REQUEST images are sent as file parts of a single multipart request.
+        Attachments that already exist are deleted first (the existence check uses existing_attachments, the
+        result of get_page_attachments, which is fetched once if not given), so every upload is version 1."""
+
+        page_id = self.get_confluence_page_id_from_url(page_url)
+
+        # See: https://support.atlassian.com/confluence/kb/using-the-confluence-rest-api-to-upload-an-attachment-to-one-or-more-pages/
+        request_url = f'{cfg.CONFLUENCE_BASE_URL}/rest/api/content/{page_id}/child/attachment'
+
+        if existing_attachments is None:
+            existing_attachments = self.get_page_attachments(page_url)
+
+        images = sorted(image_checksums.items())
+        for image_path, _ in images:
+            attachment = existing_attachments.get(os.path.basename(image_path))
+            if attachment is not None:
+                print(f"Deleting existing attachment with id: {attachment['id']}")
+                self.delete_confluence_attachment(attachment['id'], "current")
+                self.delete_confluence_attachment(attachment['id'], "trashed")
+
+        created_attachments = []
+        for i in range(0, len(images), cfg.CONFLUENCE_ATTACHMENTS_PER_REQUEST):
+            batch = images[i:i + cfg.CONFLUENCE_ATTACHMENTS_PER_REQUEST]
+            print(f"Uploading {len(batch)} images to Confluence page: {page_id}...")
+
+            with contextlib.ExitStack() as stack:
+                files = []
+                comments = []
+                for image_path, checksum in batch:
+                    file_handle = stack.enter_context(open(image_path, 'rb'))
+                    files.append(('file', (os.path.basename(image_path), file_handle, 'image/png')))
+                    # Confluence matches the comments to the files by their order
+                    comments.append(f"{ATTACHMENT_CHECKSUM_COMMENT_PREFIX}{checksum or file_sha256(image_path)}")
+
+                response = self._session.post(
+                    request_url,
+                    headers={
+                        "Accept": "application/json",
+                        "X-Atlassian-Token": "no-check"
+                    },
+                    auth=cfg.CONFLUENCE_AUTH,
+                    files=files,
+                    data={
+                        "minorEdit": "true",
+                        "comment": comments
+                    }
+                )
 
             response.raise_for_status()
-            print(f"Successfully uploaded image version to Confluence")
+            created_attachments.extend(response.json().get('results', []))
 
-            data = response.json()
-            return data
+        print(f"Successfully uploaded {len(images)} images to Confluence")
+        return created_attachments
 
 
     def get_confluence_page_title(self, confluence_page_url):
-        data = self.get_confluence_page_contents(confluence_page_url)
-        return data['title']
+        return self.get_page_metadata(confluence_page_url)['title']
+
+
+    def _cache_page(self, data):
+        page_metadata = {
+            'id': data['id'],
+            'title': data['title'],
+            'version': data['version']['number'],
+            'body': None,
+            'body_hash': None,
+        }
+        with _page_cache_lock:
+            cached_metadata = _page_cache.get(data['id'], {})
+            if 'body' in data:
+                body = data['body']['storage']['value']
+                page_metadata['body'] = body
+                page_metadata['body_hash'] = hashlib.sha256(body.encode('utf-8')).hexdigest()
+            elif cached_metadata.get('version') == page_metadata['version']:
+                # metadata only, the body we already have is still current
+                for key in ('body', 'body_hash', 'canonical_digest'):
+                    if key in cached_metadata:
+                        page_metadata[key] = cached_metadata[key]
+
+            properties = data.get('metadata', {}).get('properties')
+            if properties is not None:
+                page_metadata['appearance_property'] = properties.get(PAGE_APPEARANCE_PROPERTY_KEY)
+            else:
+                # e.g. the response of a page update, which does not change the properties
+                page_metadata['appearance_property'] = cached_metadata.get('appearance_property')
+            _page_cache[data['id']] = page_metadata
+        return page_metadata
 
 
     def get_confluence_page_contents(self, confluence_page_url):
         page_id = self.get_confluence_page_id_from_url(confluence_page_url)
-        request_url = f'{cfg.CONFLUENCE_BASE_URL}/rest/api/content/{page_id}?expand=body.storage,version'
-        resp = requests.get(
+        request_url = f'{cfg.CONFLUENCE_BASE_URL}/rest/api/content/{page_id}?expand={PAGE_EXPAND}'
+        resp = self._session.get(
             request_url, 
             headers={"Accept": "application/json"}, 
             auth=cfg.CONFLUENCE_AUTH
         )
         resp.raise_for_status()
-        return resp.json()
+        data = resp.json()
+        self._cache_page(data)
+        return data
+
+
+    def get_cached_page_metadata(self, confluence_page_url):
+        """Return the cached metadata of a page without asking Confluence, or None if the page was not read yet"""
+
+        page_id = self.get_confluence_page_id_from_url(confluence_page_url)
+        with _page_cache_lock:
+            return _page_cache.get(page_id)
+
+
+    def get_page_metadata(self, confluence_page_url, with_body=False):
+        """Return the cached title, version, body, body hash and appearance property of a page, the page is fetched once per run.
+
+        Prefetched pages may not have their body (None) yet, with_body makes sure it is there."""
+
+        page_id = self.get_confluence_page_id_from_url(confluence_page_url)
+        with _page_cache_lock:
+            page_metadata = _page_cache.get(page_id)
+        if page_metadata is None or (with_body and page_metadata['body'] is None):
+            self.get_confluence_page_contents(confluence_page_url)
+            with _page_cache_lock:
+                page_metadata = _page_cache[page_id]
+        return page_metadata
+
+
+    def clear_page_cache(self):
+        with _page_cache_lock:
+            _page_cache.clear()
+
+
+    def prefetch_pages(self, page_urls):
+        """Fill the page metadata cache for many pages at once, using CQL searches by page id.
+
+        Only the metadata is fetched, page bodies are read later for the pages that need them."""
+
+        with _page_cache_lock:
+            page_ids = sorted(set(self.get_confluence_page_id_from_url(url) for url in page_urls) - set(_page_cache))
+
+        print(f"Prefetching metadata of {len(page_ids)} Confluence pages...")
+        for i in range(0, len(page_ids), CONFLUENCE_PAGES_PER_SEARCH):
+            chunk = page_ids[i:i + CONFLUENCE_PAGES_PER_SEARCH]
+            resp = self._session.get(
+                f'{cfg.CONFLUENCE_BASE_URL}/rest/api/content/search',
+                headers={"Accept": "application/json"},
+                auth=cfg.CONFLUENCE_AUTH,
+                params={
+                    "cql": f"id in ({','.join(chunk)})",
+                    "expand": PAGE_METADATA_EXPAND,
+                    "limit": len(chunk)
+                }
+            )
+            resp.raise_for_status()
+            for data in resp.json()['results']:
+                self._cache_page(data)
 
 
     def download_current_confluence_page(self, confluence_page_url):        
@@ -168,6 +372,8 @@ class Confluence:
         page_title = data['title']
         page_title_for_file = re.sub(r'[^a-zA-Z0-9_\-]', '-', page_title)
         html_content = data['body']['storage']['value']
+        # only needed here, bs4 takes long to import
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(html_content, "html.parser")
         html_content = soup.prettify()
         with open(f"{cfg.TEMP_RENDER_FOLDER}/current-confluence-page-{page_id}-{page_title_for_file}.html", "w", encoding="utf-8") as f:
@@ -178,86 +384,168 @@ class Confluence:
         return page_title
 
 
-    def _remove_nondata_attributes(self, html):
-        soup = BeautifulSoup(html, "html.parser")
-        for tag in soup.find_all(True):  # True = all tags
-            if 'ri:version-at-save' in tag.attrs:
-                del tag.attrs['ri:version-at-save']
-        return str(soup)
+    def get_page_attachments(self, page_url):
+        """Return all current attachments of a page as a dict filename -> attachment"""
+
+        page_id = self.get_confluence_page_id_from_url(page_url)
+        request_url = f'{cfg.CONFLUENCE_BASE_URL}/rest/api/content/{page_id}/child/attachment?limit=200&expand=version,metadata'
+
+        attachments = {}
+        while request_url:
+            resp = self._session.get(request_url, headers={"Accept": "application/json"}, auth=cfg.CONFLUENCE_AUTH)
+            resp.raise_for_status()
+            data = resp.json()
+            for attachment in data['results']:
+                attachments[attachment['title']] = attachment
+
+            next_link = data.get('_links', {}).get('next')
+            request_url = f'{cfg.CONFLUENCE_BASE_URL}{next_link}' if next_link else None
+
+        return attachments
+
 
+    def _get_attachment_checksum(self, attachment):
+        comment = attachment.get('metadata', {}).get('comment') or ''
+        if comment.startswith(ATTACHMENT_CHECKSUM_COMMENT_PREFIX):
+            return comment[len(ATTACHMENT_CHECKSUM_COMMENT_PREFIX):]
+        return None
 
-    def remove_all_page_attachments(self, page_url):
-        print(f"Removing all attachments from page: {page_url} ...")
+
+    def sync_page_attachments(self, page_url, image_checksums):
+        """Make the attachments of a page match the given local images, dict image_path -> SHA-256 (or None if unknown).
+
+        If the publish ledger shows that exactly these images were published to the page, nothing is sent to
+        Confluence. Otherwise the page attachments are listed once and compared by the checksum stored in their
+        comment: only new or changed images are uploaded and attachments without a local image are deleted.
+        A changed image replaces the old attachment instead of adding a version, so the pages keep referring to
+        version 1 of each image."""
+
+        print(f"Syncing attachments of page: {page_url} ...")
         page_id = self.get_confluence_page_id_from_url(page_url)
-        request_url = f'{cfg.CONFLUENCE_BASE_URL}/rest/api/content/{page_id}/child/attachment'
-        resp = requests.get(request_url, headers={"Accept": "application/json"}, auth=cfg.CONFLUENCE_AUTH)
-        resp.raise_for_status()
-        attachments = resp.json()['results']
 
-        if len(attachments) == 0:
-            print(f"  ... no attachments found")
-            return
+        local_images = {}
+        for image_path, checksum in image_checksums.items():
+            local_images[os.path.basename(image_path)] = (image_path, checksum or file_sha256(image_path))
+
+        local_checksums = {filename: checksum for filename, (_, checksum) in local_images.items()}
+        if get_ledger().get_attachments(page_id) == local_checksums:
+            print(f"  ... all {len(local_images)} attachments unchanged since the last publication")
+            return {
+                'uploaded': 0,
+                'unchanged': len(local_images),
+                'deleted': 0,
+            }
+
+        attachments = self.get_page_attachments(page_url)
+
+        changed_images = {}
+        unchanged = 0
+        for filename, (image_path, checksum) in sorted(local_images.items()):
+            attachment = attachments.get(filename)
+            if attachment is not None and self._get_attachment_checksum(attachment) == checksum:
+                unchanged += 1
+                continue
+
+            if cfg.SKIP_UPLOAD_IMAGES_TO_CONFLUENCE_FOR_DEBUG:
+                print(f"  DEBUG: Skipping upload of {filename}")
+                continue
+
+            print(f"  {'Replacing changed' if attachment is not None else 'Uploading new'} attachment: {filename}")
+            changed_images[image_path] = checksum
+
+        if changed_images:
+            self.upload_images_to_confluence(page_url, changed_images, attachments)
+        uploaded = len(changed_images)
 
-        print(f"Found {len(attachments)} attachments")
+        deleted = 0
+        for filename, attachment in sorted(attachments.items()):
+            if filename in local_images:
+                continue
 
-        for attachment in attachments:
-            attachment_status = attachment['status']
+            if cfg.SKIP_DELETE_EXISTING_IMAGES_FOR_DEBUG:
+                print(f"  DEBUG: Skipping deletion of {filename}")
+                continue
+
+            print(f"  Deleting orphaned attachment: {filename}")
             self.delete_confluence_attachment(attachment['id'], "current")
             self.delete_confluence_attachment(attachment['id'], "trashed")
+            deleted += 1
+
+        if not cfg.SKIP_UPLOAD_IMAGES_TO_CONFLUENCE_FOR_DEBUG and not cfg.SKIP_DELETE_EXISTING_IMAGES_FOR_DEBUG:
+            get_ledger().record_attachments(page_id, local_checksums)
 
-        print(f"  ... removed all attachments from page: {page_url}")
+        print(f"  ... {uploaded} uploaded, {unchanged} unchanged, {deleted} deleted")
+        return {
+            'uploaded': uploaded,
+            'unchanged': unchanged,
+            'deleted': deleted,
+        }
 
 
     def update_confluence_page_contents(self, page_url, new_content):
 
-        old_content = self.get_confluence_page_contents(page_url)
-        page_title = old_content['title']
+        page_id = self.get_confluence_page_id_from_url(page_url)
 
-        # Get the old page content (HTML, as string)
-        old_html = self._remove_nondata_attributes(old_content['body']['storage']['value'])
-        new_html = self._remove_nondata_attributes(new_content)
+        # Compare canonical digests of the HTMLs, ignoring formatting and attributes Confluence maintains itself
+        new_digest = canonical_digests([new_content], cfg.CANONICAL_PROCESS_POOL_MIN_SIZE)[0]
 
-        # Normalize both HTMLs for comparison using BeautifulSoup's prettify (formatting)
-        soup_old = BeautifulSoup(old_html, "html.parser")
-        prettified_old = soup_old.prettify()
-        soup_new = BeautifulSoup(new_html, "html.parser")
-        prettified_new = soup_new.prettify()
+        # If we published exactly this content before, and the page was not edited since (as far as we know
+        # from the prefetched metadata, if any), there is no need to even read the page
+        published = get_ledger().get_page(page_id)
+        cached_metadata = self.get_cached_page_metadata(page_url)
+        if published is not None and published['body_digest'] == new_digest \
+            and (cached_metadata is None or cached_metadata['version'] == published['version']):
+            print("NO CHANGES SINCE THE LAST PUBLICATION! Skipping update.")
+            return published['title']
 
-        # If the formatted content is identical, do not proceed with update
-        if prettified_old.strip() == prettified_new.strip():
+        page_metadata = self.get_page_metadata(page_url, with_body=True)
+        page_title = page_metadata['title']
+
+        if page_metadata.get('canonical_digest') is None:
+            page_metadata['canonical_digest'] = canonical_digests([page_metadata['body']], cfg.CANONICAL_PROCESS_POOL_MIN_SIZE)[0]
+
+        # If the canonical content is identical, do not proceed with update
+        if page_metadata['canonical_digest'] == new_digest:
             print("NO CHANGES DETECTED! Skipping update.")
+            get_ledger().record_page(page_id, new_digest, page_metadata['version'], page_title)
             return page_title
 
-        page_id = self.get_confluence_page_id_from_url(page_url)
-
         api_url = f"{cfg.CONFLUENCE_BASE_URL}/rest/api/content/{page_id}"
         headers = {
             "Content-Type": "application/json",
             "Accept": "application/json"
         }
-        resp = requests.get(api_url, headers=headers, auth=cfg.CONFLUENCE_AUTH)
-        resp.raise_for_status()
-        current_title = resp.json()['title']
-        current_version = resp.json()["version"]["number"]
-
-        payload = {
-                "id": page_id,
-                "type": "page",
-                "title": current_title,
-                "body": {
-                    "storage": {
-                        "value": new_content,
-                        "representation": "storage"
-                    }
-                },
-                "version": {
-                "number": current_version + 1
+
+        def put_page_contents(page_metadata):
+            payload = {
+                    "id": page_id,
+                    "type": "page",
+                    "title": page_metadata['title'],
+                    "body": {
+                        "storage": {
+                            "value": new_content,
+                            "representation": "storage"
+                        }
+                    },
+                    "version": {
+                    "number": page_metadata['version'] + 1
+                }
             }
-        }
-        put_response = requests.put(api_url, headers=headers, json=payload, auth=cfg.CONFLUENCE_AUTH)
+            return self._session.put(api_url, headers=headers, json=payload, auth=cfg.CONFLUENCE_AUTH)
+
+        put_response = put_page_contents(page_metadata)
+        if put_response.status_code == 409:
+            # The page was edited since we cached it, refresh the version and try again
+            print("Page version conflict, refreshing page metadata...")
+            self.get_confluence_page_contents(page_url)
+            put_response = put_page_contents(self.get_page_metadata(page_url))
         put_response.raise_for_status()
 
-        # also just to make sure all these pages look alike, we make it full width
-        self.make_page_full_width(page_url)
+        # The response carries the new version and body, no need to read the page again
+        put_data = put_response.json()
+        put_data['body'] = {'storage': {'value': new_content}}
+        page_metadata = self._cache_page(put_data)
+        page_metadata['canonical_digest'] = new_digest
+        get_ledger().record_page(page_id, new_digest, page_metadata['version'], page_metadata['title'])
 
-        return page_title
\ No newline at end of file
+        return page_title
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Responses worth another attempt, Retry-After is honoured
+CONFLUENCE_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Responses telling us to slow down
+CONFLUENCE_THROTTLING_STATUS_CODES = (429, 503)
+
+
+class _ConfluenceRetry(Retry):
+    """Retry idempotent requests on transient errors, and POST requests only when throttled as these were not processed"""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method and method.upper() == 'POST':
+            return status_code == 429 and bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class _AdaptiveConcurrencyAdapter(HTTPAdapter):
+    """Adapter sending every request through an AdaptiveConcurrencyLimit"""
+
+    def __init__(self, concurrency_limit, **kwargs):
+        self.concurrency_limit = concurrency_limit
+        super().__init__(**kwargs)
+
+
+    def send(self, request, **kwargs):
+
+        self.concurrency_limit.acquire()
+        start = time.monotonic()
+        throttled = False
+        try:
+            response = super().send(request, **kwargs)
+            # Throttled attempts retried by urllib3 are recorded in the retry history of the final response
+            retries = getattr(response.raw, 'retries', None)
+            retried_statuses = [history.status for history in retries.history] if retries else []
+            throttled = any(status in CONFLUENCE_THROTTLING_STATUS_CODES for status in retried_statuses + [response.status_code])
+            return response
+        finally:
+            self.concurrency_limit.release(time.monotonic() - start, throttled)
+
+
+def create_session(concurrency_limit, pool_size, max_retries):
+    """Return a requests session with one connection pool, the retry policy and the adaptive concurrency limit of the Confluence client"""
+
+    retry = _ConfluenceRetry(
+        total=max_retries,
+        backoff_factor=1,
+        status_forcelist=CONFLUENCE_RETRY_STATUS_CODES,
+        raise_on_status=False
+    )
+    # pool_block makes threads wait for a free connection, on top of the adaptive limit
+    adapter = _AdaptiveConcurrencyAdapter(
+        concurrency_limit,
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        pool_block=True,
+        max_retries=retry
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
@@ -1,71 +1,261 @@
 #!/usr/bin/env python
 
-from config import Config
-import requests
+from config import cfg
+from render_cache import RenderCache
+from render_registry import RenderRegistry
+from throttling import TokenBucket, parse_retry_after
+from metrics import metrics
+from tracing import tracer
+from util import copy_file_atomically
 import re
+import os
+import time
+import hashlib
+import tempfile
+import functools
+import threading
+import concurrent.futures
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 
-cfg = Config()
+
+# Maximum number of node ids requested in a single /v1/images call, keeps the URL short and the render time reasonable
+FIGMA_MAX_IDS_PER_REQUEST = 50
+
+# Responses of the Figma API that are worth another attempt
+FIGMA_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Responses rejecting a /v1/images call because of one of its node ids (e.g. a deleted frame), worth splitting the call
+FIGMA_BROKEN_NODE_STATUS_CODES = (400, 404)
+
+# Rendered images are streamed to disk in chunks of this size instead of being loaded into memory
+FIGMA_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Render settings, scale x2 for better quality
+FIGMA_RENDER_SCALE = 2
+FIGMA_RENDER_FORMAT = 'png'
+
+
+# Figma file key and frame (node) id in a Figma URL
+FIGMA_FILE_KEY_PATTERN = re.compile(r'figma\.com/(file|proto|design)/([a-zA-Z0-9]+)')
+FIGMA_NODE_ID_PATTERN = re.compile(r'node-id=([\d:-]+)')
+
+
+class FigmaThrottledError(Exception):
+    """Figma kept throttling a request (429) after all retries, the request was not processed"""
+    pass
+
+
+def sanitize_figma_url(figma_url):
+    """Remove the t= parameter from Figma URL if it exists"""
+    parsed = urlparse(figma_url)
+
+    # Parse query parameters
+    query_params = parse_qs(parsed.query, keep_blank_values=True)
+
+    # Remove the 't' parameter if it exists
+    if 't' in query_params:
+        del query_params['t']
+
+    # Reconstruct query string (parse_qs returns lists, so we need to flatten)
+    new_query = urlencode(query_params, doseq=True)
+
+    # Reconstruct the URL
+    return urlunparse((
+        parsed.scheme,
+        parsed.netloc,
+        parsed.path,
+        parsed.params,
+        new_query,
+        parsed.fragment
+    ))
+
+
+# Every link is parsed once per process: when the schemas are loaded, then served from here to the planner and renders
+@functools.lru_cache(maxsize=None)
+def parse_figma_url(figma_url):
+    """Return the (file key, node id) of a Figma URL, the node id as the API expects it; raises ValueError if either is missing"""
+
+    # Sanitize URL to remove t= parameter
+    figma_url = sanitize_figma_url(figma_url)
+
+    file_key_match = FIGMA_FILE_KEY_PATTERN.search(figma_url)
+    if not file_key_match:
+        raise ValueError("Could not extract Figma file key from URL")
+    file_key = file_key_match.group(2)
+
+    node_id_match = FIGMA_NODE_ID_PATTERN.search(figma_url)
+    if not node_id_match:
+        raise ValueError("Could not extract node-id from URL")
+
+    return file_key, node_id_match.group(1).replace(':', '%3A')
 
 
 class Figma:
 
-    def _sanitize_figma_url(self, figma_url):
-        """Remove the t= parameter from Figma URL if it exists"""
-        parsed = urlparse(figma_url)
-        
-        # Parse query parameters
-        query_params = parse_qs(parsed.query, keep_blank_values=True)
-        
-        # Remove the 't' parameter if it exists
-        if 't' in query_params:
-            del query_params['t']
-        
-        # Reconstruct query string (parse_qs returns lists, so we need to flatten)
-        new_query = urlencode(query_params, doseq=True)
-        
-        # Reconstruct the URL
-        return urlunparse((
-            parsed.scheme,
-            parsed.netloc,
-            parsed.path,
-            parsed.params,
-            new_query,
-            parsed.fragment
-        ))
-
-
-    def _get_frame_id_from_url(self, figma_url):
-
-        match = re.search(r'node-id=([\d:-]+)', figma_url)
-        if match:
-            return match.group(1).replace(':', '%3A')
-        return None
+    def __init__(self):
+        self.render_cache = RenderCache(os.path.join(cfg.CACHE_FOLDER, 'renders'), cfg.RENDER_CACHE_MAX_BYTES)
+        # When False, every image is rendered again, the render cache is only written
+        self.use_render_cache = True
+        # Frames rendered in this run, shared by every record pointing at them
+        self.render_registry = RenderRegistry()
+        # Figma file key -> Future of its version, see _get_file_version
+        self._file_versions = {}
+        self._file_versions_lock = threading.Lock()
+        # (file key, node key) -> image URL (None if Figma could not render the frame) requested ahead of the render, see prefetch_renders
+        self._prefetched_image_urls = {}
+        self._prefetched_image_urls_lock = threading.Lock()
+        self._sessions_lock = threading.Lock()
 
+        self._api_rate_limiter = TokenBucket(cfg.FIGMA_MAX_REQUESTS_PER_MINUTE / 60, cfg.FIGMA_MAX_CONCURRENT_REQUESTS)
+        self.set_concurrency(cfg.FIGMA_MAX_CONCURRENT_REQUESTS, cfg.FIGMA_MAX_CONCURRENT_DOWNLOADS)
 
-    def render_figma_png(self, figma_url, out_filename):
 
-        # Sanitize URL to remove t= parameter
-        figma_url = self._sanitize_figma_url(figma_url)
+    def set_concurrency(self, max_concurrent_requests, max_concurrent_downloads):
+        """Set the number of API requests and image downloads in flight, must not be called while rendering"""
 
-        # print(f"Rendering Figma PNG to file: {out_filename}...")
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_concurrent_downloads = max_concurrent_downloads
+
+        # Keep-alive connection pools: one session for the API (carries the token), one for the image CDN,
+        # created on first use. The semaphores cap the requests in flight across all threads using this instance.
+        with self._sessions_lock:
+            self._api_session = None
+            self._download_session = None
+        self._api_slots = threading.BoundedSemaphore(max_concurrent_requests)
+        self._download_slots = threading.BoundedSemaphore(max_concurrent_downloads)
+
+
+    def _create_session(self, pool_size, service):
+        # requests is only imported once Figma is asked, runs served from local state (e.g. --plan) do without it
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        metrics.instrument_session(session, service)
+        tracer.instrument_session(session, service)
+        return session
+
+
+    def _get_api_session(self):
 
-        file_key_match = re.search(r'figma\.com/(file|proto|design)/([a-zA-Z0-9]+)', figma_url)
-        if not file_key_match:
-            raise ValueError("Could not extract Figma file key from URL")
-        file_key = file_key_match.group(2)
-        # print(f"File key: {file_key}")
+        with self._sessions_lock:
+            if self._api_session is None:
+                self._api_session = self._create_session(self.max_concurrent_requests, 'figma')
+                self._api_session.headers["X-Figma-Token"] = cfg.FIGMA_API_TOKEN
+            return self._api_session
 
-        node_id = self._get_frame_id_from_url(figma_url)
-        if not node_id:
-            raise ValueError("Could not extract node-id from URL")
-        # print(f"Node ID: {node_id}")
 
-        api_url = f"https://api.figma.com/v1/images/{file_key}?ids={node_id}&format=png&scale=2" # scale x2 for better quality
-        headers = {
-            "X-Figma-Token": cfg.FIGMA_API_TOKEN
+    def _get_download_session(self):
+
+        with self._sessions_lock:
+            if self._download_session is None:
+                self._download_session = self._create_session(self.max_concurrent_downloads, 'figma-images')
+            return self._download_session
+
+
+    def _api_get(self, api_url):
+        """GET from the Figma API through the rate limiter, retrying throttled (429) and transient 5xx responses.
+
+        Raises FigmaThrottledError when Figma still throttles us after the retries, or asks to wait longer than we would."""
+
+        attempt = 0
+        while True:
+            self._api_rate_limiter.acquire()
+            with self._api_slots:
+                resp = self._get_api_session().get(api_url)
+
+            if resp.status_code not in FIGMA_RETRY_STATUS_CODES:
+                self._api_rate_limiter.on_success()
+                return resp
+
+            wait = parse_retry_after(resp.headers.get('Retry-After'))
+            if wait is None:
+                wait = 2 ** attempt
+            if attempt >= cfg.FIGMA_MAX_RETRIES:
+                give_up_reason = f"after {attempt} retries"
+            elif wait > cfg.FIGMA_MAX_RETRY_WAIT_SECONDS:
+                give_up_reason = f"and asks to retry after {wait:.0f}s, which is more than we are willing to wait"
+            else:
+                give_up_reason = None
+
+            if resp.status_code == 429:
+                # also when giving up: every throttled request slows down (and holds back) the requests of all threads
+                self._api_rate_limiter.on_throttled(min(wait, cfg.FIGMA_MAX_RETRY_WAIT_SECONDS))
+
+            if give_up_reason is not None:
+                print(f"Figma API returned {resp.status_code} for {api_url} {give_up_reason}, giving up")
+                if resp.status_code == 429:
+                    raise FigmaThrottledError(f"Figma API throttled {api_url} {give_up_reason}")
+                return resp
+
+            print(f"Figma API returned {resp.status_code} for {api_url}, retrying in {wait:.1f}s...")
+            if resp.status_code != 429:
+                time.sleep(wait)
+            self._api_rate_limiter.on_retry()
+            metrics.record_retry('figma')
+            attempt += 1
+
+
+    def get_request_stats(self):
+        return {
+            'throttled': self._api_rate_limiter.throttled_count,
+            'retried': self._api_rate_limiter.retried_count,
+            'rate_per_minute': round(self._api_rate_limiter.rate * 60, 1),
+            'shared_renders': self.render_registry.shared_count,
         }
-        resp = requests.get(api_url, headers=headers)
+
+
+    def _sanitize_figma_url(self, figma_url):
+        return sanitize_figma_url(figma_url)
+
+
+    def _get_node_key(self, node_id):
+        # weirdly the node-id is formatted with colons instead of hyphens in the API responses
+        return node_id.replace('%3A', ':').replace('-', ':')
+
+
+    def _parse_figma_url(self, figma_url):
+        return parse_figma_url(figma_url)
+
+
+    @tracer.traced('figma')
+    def _get_file_version(self, file_key):
+        """Return the current version of a Figma file (fetched once per run), or None if it cannot be determined.
+
+        Concurrent callers asking for the same file wait for the first one to fetch it."""
+
+        with self._file_versions_lock:
+            future = self._file_versions.get(file_key)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._file_versions[file_key] = future
+        if not owner:
+            return future.result()
+
+        file_version = None
+        try:
+            api_url = f"{cfg.FIGMA_API_URL}/v1/files/{file_key}?depth=1"
+            resp = self._api_get(api_url)
+            resp.raise_for_status()
+            json_result = resp.json()
+            file_version = json_result.get('version') or json_result.get('lastModified')
+        except Exception as e:
+            print(f"Could not get the version of Figma file {file_key}, not using the render cache for it: {e}")
+        finally:
+            # set even if fetching was interrupted, the callers waiting for it would wait forever otherwise
+            future.set_result(file_version)
+        return file_version
+
+
+    @tracer.traced('figma')
+    def _request_image_urls(self, file_key, node_ids):
+
+        api_url = f"{cfg.FIGMA_API_URL}/v1/images/{file_key}?ids={','.join(node_ids)}&format={FIGMA_RENDER_FORMAT}&scale={FIGMA_RENDER_SCALE}"
+        resp = self._api_get(api_url)
         if resp.status_code == 403:
             raise RuntimeError(
                 f"Figma API returned 403 Forbidden. This usually means your token is EXPIRED, incorrect, or does not have access to the file.\n"
@@ -74,19 +264,272 @@ class Figma:
                 f"Response: {resp.text}"
             )
         resp.raise_for_status()
-        json_result = resp.json()
-        image_url = json_result['images'][node_id.replace('-', ':')] # weirdly the node-id is formatted with colons instead of hyphens here
-        # print(f"Image URL: {image_url}")
-
-        if image_url is None:
-            print(f"Rendering failed for {figma_url} - no image URL found. Link is no longer valid?")
-            raise ValueError(f"Rendering failed for {figma_url} - no image URL found. Link is no longer valid?")
-        
-        # Download image
-        img_resp = requests.get(image_url)
-        img_resp.raise_for_status()
-        with open(out_filename, 'wb') as f:
-            f.write(img_resp.content)
-        
+        return resp.json()['images']
+
+
+    def _request_image_urls_batched(self, file_key, node_ids):
+        """Request image URLs for the given node ids of one file, returns a dict node key -> image URL or exception"""
+
+        import requests
+
+        results = {}
+        for i in range(0, len(node_ids), FIGMA_MAX_IDS_PER_REQUEST):
+            chunk = node_ids[i:i + FIGMA_MAX_IDS_PER_REQUEST]
+            try:
+                results.update(self._request_image_urls(file_key, chunk))
+            except requests.HTTPError as e:
+                # throttled or failing (429, 5xx after the retries of _api_get): splitting would only send more requests
+                status_code = e.response.status_code if e.response is not None else None
+                if len(chunk) == 1 or status_code not in FIGMA_BROKEN_NODE_STATUS_CODES:
+                    for node_id in chunk:
+                        results[self._get_node_key(node_id)] = e
+                    continue
+                # A single broken node makes Figma reject the whole request, so split the chunk to isolate it
+                middle = len(chunk) // 2
+                results.update(self._request_image_urls_batched(file_key, chunk[:middle]))
+                results.update(self._request_image_urls_batched(file_key, chunk[middle:]))
+            except Exception as e:
+                for node_id in chunk:
+                    results[self._get_node_key(node_id)] = e
+        return results
+
+
+    def _make_render_cache_key(self, file_key, node_id, file_version):
+        return self.render_cache.make_key(file_key, self._get_node_key(node_id), FIGMA_RENDER_SCALE, FIGMA_RENDER_FORMAT, file_version)
+
+
+    @tracer.traced('figma')
+    def prefetch_renders(self, file_key, node_ids):
+        """Request the renders of many frames of one Figma file at once, ahead of the render_figma_pngs calls needing them.
+
+        Render jobs run per object, this keeps the frames of all objects in as few /v1/images calls as possible.
+        Frames the render cache serves are left out. The image URLs are kept until a render job takes them, so it
+        only has to download the image; frames whose request failed are requested again by their render job."""
+
+        # the same frame may be linked with node ids in different forms
+        node_ids = {self._get_node_key(node_id): node_id for node_id in node_ids}
+
+        file_version = self._get_file_version(file_key)
+        if file_version is not None and self.use_render_cache:
+            node_ids = {
+                node_key: node_id for node_key, node_id in node_ids.items()
+                if not self.render_cache.contains(self._make_render_cache_key(file_key, node_id, file_version))
+            }
+        if not node_ids:
+            return
+
+        print(f"Requesting {len(node_ids)} Figma renders for file {file_key} ahead of the render jobs...")
+        image_urls = self._request_image_urls_batched(file_key, sorted(node_ids.values()))
+
+        with self._prefetched_image_urls_lock:
+            for node_key in node_ids:
+                image_url = image_urls.get(node_key)
+                if not isinstance(image_url, Exception):
+                    self._prefetched_image_urls[(file_key, node_key)] = image_url
+
+
+    def _take_prefetched_image_urls(self, file_key, node_ids):
+        # Returns (node key -> image URL of the prefetched node ids, node ids still to request)
+
+        image_urls = {}
+        remaining_node_ids = []
+        with self._prefetched_image_urls_lock:
+            for node_id in node_ids:
+                node_key = self._get_node_key(node_id)
+                if (file_key, node_key) in self._prefetched_image_urls:
+                    image_urls[node_key] = self._prefetched_image_urls.pop((file_key, node_key))
+                else:
+                    remaining_node_ids.append(node_id)
+        return image_urls, remaining_node_ids
+
+
+    def clear_prefetched_renders(self):
+
+        with self._prefetched_image_urls_lock:
+            self._prefetched_image_urls = {}
+
+
+    def _download_image(self, image_url, out_filename):
+        """Stream the image into a temporary file next to out_filename and atomically move it in place.
+
+        Returns the SHA-256 checksum of the image, computed while downloading."""
+
+        checksum = hashlib.sha256()
+        temp_fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(out_filename), suffix='.part')
+        # one span per rendered record, named after its image
+        try:
+            with tracer.span('Figma._download_image', 'figma', image=os.path.relpath(out_filename, cfg.TEMP_RENDER_FOLDER)):
+                with os.fdopen(temp_fd, 'wb') as f:
+                    with self._download_slots:
+                        with self._get_download_session().get(image_url, stream=True) as img_resp:
+                            img_resp.raise_for_status()
+                            for chunk in img_resp.iter_content(chunk_size=FIGMA_DOWNLOAD_CHUNK_SIZE):
+                                f.write(chunk)
+                                checksum.update(chunk)
+            os.replace(temp_filename, out_filename)
+        except BaseException:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+
+        return checksum.hexdigest()
+
+
+    def _prepare_file_downloads(self, file_key, jobs):
+        """Resolve the jobs of one Figma file to image downloads.
+
+        Returns (results, downloads, cache_keys): results of jobs that are already settled (served from the
+        render cache or failed, see render_figma_pngs), (image_url, out_filename) pairs to download, and out_filename -> render cache key."""
+
+        results = {}
+        downloads = []
+        cache_keys = {}
+
+        file_version = self._get_file_version(file_key)
+        if file_version is not None:
+            uncached_jobs = []
+            for figma_url, node_id, out_filename in jobs:
+                cache_key = self._make_render_cache_key(file_key, node_id, file_version)
+                checksum = self.render_cache.get(cache_key, out_filename) if self.use_render_cache else None
+                if checksum is not None:
+                    results[out_filename] = checksum
+                else:
+                    cache_keys[out_filename] = cache_key
+                    uncached_jobs.append((figma_url, node_id, out_filename))
+
+            print(f"Render cache: {len(jobs) - len(uncached_jobs)} of {len(jobs)} images of Figma file {file_key} are up to date")
+            jobs = uncached_jobs
+
+        if not jobs:
+            return results, downloads, cache_keys
+
+        node_ids = sorted(set(node_id for _, node_id, _ in jobs))
+        image_urls, node_ids = self._take_prefetched_image_urls(file_key, node_ids)
+        if node_ids:
+            print(f"Requesting {len(node_ids)} Figma renders for file {file_key}...")
+            image_urls.update(self._request_image_urls_batched(file_key, node_ids))
+
+        for figma_url, node_id, out_filename in jobs:
+            image_url = image_urls.get(self._get_node_key(node_id))
+            if isinstance(image_url, Exception):
+                results[out_filename] = image_url
+            elif image_url is None:
+                print(f"Rendering failed for {figma_url} - no image URL found. Link is no longer valid?")
+                results[out_filename] = ValueError(f"Rendering failed for {figma_url} - no image URL found. Link is no longer valid?")
+            else:
+                downloads.append((image_url, out_filename))
+
+        return results, downloads, cache_keys
+
+
+    def _render_jobs(self, jobs):
+        """Render a list of (figma_url, file_key, node_id, out_filename), returns a dict out_filename -> checksum or exception"""
+
+        results = {}
+        jobs_by_file_key = {}
+        for figma_url, file_key, node_id, out_filename in jobs:
+            jobs_by_file_key.setdefault(file_key, []).append((figma_url, node_id, out_filename))
+
+        downloads = []
+        cache_keys = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrent_requests) as executor:
+            futures = [
+                executor.submit(self._prepare_file_downloads, file_key, file_jobs)
+                for file_key, file_jobs in jobs_by_file_key.items()
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                file_results, file_downloads, file_cache_keys = future.result()
+                results.update(file_results)
+                downloads.extend(file_downloads)
+                cache_keys.update(file_cache_keys)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrent_downloads) as executor:
+            futures = {
+                executor.submit(self._download_image, image_url, out_filename): out_filename
+                for image_url, out_filename in downloads
+            }
+            for future in concurrent.futures.as_completed(futures):
+                out_filename = futures[future]
+                try:
+                    results[out_filename] = future.result()
+                except Exception as e:
+                    results[out_filename] = e
+                    continue
+
+                if out_filename in cache_keys:
+                    self.render_cache.put(cache_keys[out_filename], out_filename, results[out_filename])
+
+        return results
+
+
+    def _copy_shared_render(self, render, out_filename):
+        """Wait for a frame rendered by another job and copy its image to out_filename, returns its checksum or exception"""
+
+        rendered_filename, result = self.render_registry.wait(render)
+        if isinstance(result, Exception) or rendered_filename == out_filename:
+            return result
+
+        try:
+            copy_file_atomically(rendered_filename, out_filename)
+        except OSError as e:
+            return e
+        return result
+
+
+    @tracer.traced('figma')
+    def render_figma_pngs(self, render_jobs):
+        """Render a list of (figma_url, out_filename) pairs.
+
+        Every frame (Figma file and node id, whatever else is in the URL) is rendered once per run: jobs of a frame
+        that another job (of this or of a concurrent call) renders get a copy of its image, see RenderRegistry.
+        Images of Figma files that did not change since they were last rendered are served from the render cache.
+        All other node ids of the same Figma file are requested together in as few /v1/images calls as possible,
+        then the rendered images are downloaded in parallel. Different Figma files are handled concurrently.
+        Safe to call from several threads at once, the connection pools and concurrency limits are shared.
+        Returns a dict out_filename -> SHA-256 checksum of the image on success, or the exception that prevented rendering."""
+
+        results = {}
+        owned_jobs = []
+        owned_renders = {}
+        shared_renders = []
+        for figma_url, out_filename in render_jobs:
+            try:
+                file_key, node_id = self._parse_figma_url(figma_url)
+            except ValueError as e:
+                results[out_filename] = e
+                continue
+
+            render, owner = self.render_registry.claim((file_key, self._get_node_key(node_id)))
+            if owner:
+                owned_jobs.append((figma_url, file_key, node_id, out_filename))
+                owned_renders[out_filename] = render
+            else:
+                shared_renders.append((render, out_filename))
+
+        try:
+            results.update(self._render_jobs(owned_jobs))
+        finally:
+            # settle even if rendering failed unexpectedly, jobs sharing these frames would wait forever otherwise
+            for out_filename, render in owned_renders.items():
+                result = results.get(out_filename) or RuntimeError(f"Rendering {out_filename} was interrupted")
+                self.render_registry.settle(render, out_filename, result)
+            self.render_cache.save()
+
+        if shared_renders:
+            print(f"Sharing {len(shared_renders)} Figma images with the jobs that render the same frames...")
+        for render, out_filename in shared_renders:
+            results[out_filename] = self._copy_shared_render(render, out_filename)
+
+        return results
+
+
+    def render_figma_png(self, figma_url, out_filename):
+
+        # print(f"Rendering Figma PNG to file: {out_filename}...")
+
+        result = self.render_figma_pngs([(figma_url, out_filename)])[out_filename]
+        if isinstance(result, Exception):
+            raise result
+
         # print(f"Rendered image saved as {out_filename}")
-        return out_filename
\ No newline at end of file
+        return out_filename
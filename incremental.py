@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import os
+import json
+import hashlib
+import threading
+
+from util import write_json_atomically
+
+
+def fingerprint_files(filenames):
+    """Return a SHA-256 over the names and contents of the given files, raises OSError if one of them cannot be read"""
+
+    digest = hashlib.sha256()
+    for filename in filenames:
+        digest.update(os.path.basename(filename).encode('utf-8') + b'\0')
+        with open(filename, 'rb') as f:
+            digest.update(f.read())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def fingerprint_overview(overview_name, values_array, template_files):
+    """Return a SHA-256 of everything an overview page shows: its templates, per image its object, title, link and checksum"""
+
+    digest = hashlib.sha256()
+    digest.update(overview_name.encode('utf-8') + b'\0')
+    digest.update(fingerprint_files(template_files).encode('utf-8') + b'\0')
+    for value in values_array:
+        for part in (value.parent.object_name, value.unique_key, value.title, value.figma_link, value.checksum, os.path.basename(value.filename)):
+            digest.update(str(part).encode('utf-8') + b'\1')
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class IncrementalState:
+    """Persistent fingerprints of the inputs of the last successful publication of every object and overview page.
+
+    Per object it keeps the fingerprint of its schema file and templates, and the checksums of its images, so
+    an object whose inputs did not change can be skipped and its images restored from the render cache."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._state = {'objects': {}, 'overviews': {}}
+
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'r', encoding='utf-8') as f:
+                    self._state = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f'Ignoring unreadable incremental state {filename}: {e}')
+
+
+    def get_object(self, schema_file):
+        """Return {fingerprint, checksums} of the last publication of an object, or None"""
+
+        with self._lock:
+            return self._state['objects'].get(os.path.basename(schema_file))
+
+
+    def record_object(self, schema_file, fingerprint, checksums):
+        """Record a successful publication of an object, checksums is the dict unique_key -> image checksum"""
+
+        with self._lock:
+            self._state['objects'][os.path.basename(schema_file)] = {
+                'fingerprint': fingerprint,
+                'checksums': checksums,
+            }
+            self._save()
+
+
+    def get_overview(self, overview_name):
+
+        with self._lock:
+            return self._state['overviews'].get(overview_name)
+
+
+    def record_overview(self, overview_name, fingerprint):
+
+        with self._lock:
+            self._state['overviews'][overview_name] = fingerprint
+            self._save()
+
+
+    def _save(self):
+        # called with the lock held, every record is written right away so an interrupted run keeps its progress
+        write_json_atomically(self.filename, self._state)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+import os
+import json
+import threading
+
+
+class RunJournal:
+    """Write-ahead journal of the steps of a run that are done, so an interrupted run can be resumed.
+
+    Every step (e.g. the page of an object was updated) is appended as one JSON line and synced to disk
+    before the run moves on. A step only counts as done for the same fingerprint of its inputs. The journal
+    is cleared once a complete run succeeded, as long as it exists the next run resumes from it."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        # When False, nothing is read from or written to the journal
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._steps = {}
+        self._file = None
+
+        if os.path.exists(filename):
+            with open(filename, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line may be cut short by a crash, the step it records has to be done again
+                        continue
+                    self._steps[(entry['key'], entry['step'])] = entry
+
+
+    def __len__(self):
+        return len(self._steps)
+
+
+    def get(self, key, step, fingerprint):
+        """Return the data recorded for a step done with the same fingerprint, or None"""
+
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._steps.get((key, step))
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return None
+        return entry['data']
+
+
+    def record(self, key, step, fingerprint, data=None):
+
+        if not self.enabled:
+            return
+        entry = {
+            'key': key,
+            'step': step,
+            'fingerprint': fingerprint,
+            'data': data,
+        }
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                self._file = open(self.filename, 'a', encoding='utf-8')
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._steps[(key, step)] = entry
+
+
+    def clear(self):
+
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            self._steps = {}
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+
+class PublishLedger:
+    """Persistent record (SQLite) of what was last published to each Confluence page.
+
+    Per page it keeps the canonical digest of the published body, the page version and title, and the
+    SHA-256 of every attachment, so unchanged pages and attachments can be recognised without asking Confluence."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        # When False, earlier publications are ignored (everything is compared with Confluence), new ones are still recorded
+        self.enabled = True
+        self._connection = None
+        self._lock = threading.Lock()
+
+
+    def _connect(self):
+        # called with the lock held, the database is only created once it is needed
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            self._connection = sqlite3.connect(self.filename, check_same_thread=False)
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS pages (
+                    page_id TEXT PRIMARY KEY,
+                    body_digest TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    title TEXT NOT NULL,
+                    published_at TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS attachments (
+                    page_id TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    PRIMARY KEY (page_id, filename)
+                );
+            ''')
+        return self._connection
+
+
+    def get_page(self, page_id):
+        """Return {body_digest, version, title} of the last publication of a page, or None"""
+
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT body_digest, version, title FROM pages WHERE page_id = ?',
+                (page_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            'body_digest': row[0],
+            'version': row[1],
+            'title': row[2],
+        }
+
+
+    def record_page(self, page_id, body_digest, version, title):
+
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO pages (page_id, body_digest, version, title, published_at) VALUES (?, ?, ?, ?, ?)',
+                    (page_id, body_digest, version, title, datetime.now(timezone.utc).isoformat())
+                )
+
+
+    def get_attachments(self, page_id):
+        """Return the attachments of a page as published by us, dict filename -> SHA-256, or None"""
+
+        if not self.enabled:
+            return None
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT filename, sha256 FROM attachments WHERE page_id = ?',
+                (page_id,)
+            ).fetchall()
+        # a page published without attachments looks like a page never published, both are compared with Confluence
+        if not rows:
+            return None
+        return dict(rows)
+
+
+    def record_attachments(self, page_id, attachment_checksums):
+        """Replace the recorded attachments of a page, dict filename -> SHA-256"""
+
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('DELETE FROM attachments WHERE page_id = ?', (page_id,))
+                connection.executemany(
+                    'INSERT INTO attachments (page_id, filename, sha256) VALUES (?, ?, ?)',
+                    [(page_id, filename, sha256) for filename, sha256 in attachment_checksums.items()]
+                )
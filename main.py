@@ -1,172 +1,525 @@
 #!/usr/bin/env python3
 
-import requests
 import re
 import os
 import glob
 import json
 import os
-import concurrent.futures
+import fnmatch
+import argparse
+import functools
 
 from datetime import datetime
 
-from config import Config
+from config import cfg
 from confluence import Confluence
-from schema import ObjectSchema, SchemaRecord
-from renderers.object import update_object_confluence_page
+from schema import ObjectSchema, get_figma, can_reuse_rendered_image
+from figma import parse_figma_url
+from renderers.object import update_object_confluence_page, OBJECT_PAGE_TEMPLATES
 from renderers.summary import write_summary_page
-from renderers.overview import write_overview_pages
+from renderers.overview import render_overview_page, get_overview_pages, get_overview_page_urls, OVERVIEW_PAGE_TEMPLATES
+from pipeline import Pipeline
+from incremental import IncrementalState, fingerprint_files, fingerprint_overview
+from journal import RunJournal
+from schema_loader import SchemaLoader
+from planner import RunPlanner, print_plan
+from metrics import metrics
+from tracing import tracer
 
-cfg = Config()
 confluence = Confluence()
 
 
-MAX_THREADS = 1
+# Steps of a run that can be selected on the command line, in the order they depend on each other
+PHASES = ['render', 'attachments', 'pages', 'summary', 'overviews', 'full-width']
 
 
+# The state kept between runs is opened on first use, importing this module does not read the configuration
 
-def remove_all_existing_attachments(object_schema_tuple):
+@functools.lru_cache(maxsize=None)
+def get_incremental_state():
+    return IncrementalState(os.path.join(cfg.CACHE_FOLDER, 'incremental-state.json'))
 
-    idx, object_schema = object_schema_tuple
 
-    if cfg.SKIP_DELETE_EXISTING_IMAGES_FOR_DEBUG:
-        print(f"  DEBUG: Skipping deletion of existing images for {object_schema.object_name}")
-        return
+@functools.lru_cache(maxsize=None)
+def get_journal():
+    """Return the steps done by a run that did not complete, see RunJournal"""
+    return RunJournal(os.path.join(cfg.CACHE_FOLDER, 'run-journal.jsonl'))
 
-    confluence_page_url = object_schema.confluence_page_url
-    confluence.remove_all_page_attachments(confluence_page_url)
 
+@functools.lru_cache(maxsize=None)
+def get_schema_loader():
+    """Return the loader of the schema files, it keeps the parsed schemas by content"""
+    return SchemaLoader(os.path.join(cfg.CACHE_FOLDER, 'schema-cache.json'), cfg.SCHEMA_LOADER_PROCESSES)
+
+
+def get_object_key(object_schema):
+    return os.path.basename(object_schema.schema_file)
+
+
+def get_object_fingerprint(object_schema):
+    return fingerprint_files([object_schema.schema_file] + OBJECT_PAGE_TEMPLATES)
+
+
+def get_object_checksums(object_schema):
+
+    checksums = {}
+    for unique_key, record in object_schema.all_values.items():
+        if record.checksum is not None:
+            checksums[unique_key] = record.checksum
+    return checksums
+
+
+def get_render_frames(object_schema, known_checksums=None):
+    """Return the Figma frames the records of an object may have to render, dict file key -> node ids.
+
+    Records found in known_checksums whose image can be reused (see render_figma_images) are left out."""
+
+    known_checksums = known_checksums or {}
+
+    frames = {}
+    for record in object_schema.all_values.values():
+        if record.figma_link is None:
+            continue
+        checksum = known_checksums.get(record.unique_key)
+        if checksum is not None and can_reuse_rendered_image(record, checksum):
+            continue
+        file_key, node_id = parse_figma_url(record.figma_link)
+        frames.setdefault(file_key, set()).add(node_id)
+    return frames
 
-def upload_images_to_confluence(object_schema):
 
-    if cfg.SKIP_UPLOAD_IMAGES_TO_CONFLUENCE_FOR_DEBUG:
-        print(f"  DEBUG: Skipping upload of images to Confluence for {object_schema.object_name}")
+def has_render_errors(object_schema):
+    return any(record.status == record.SCHEMA_RECORD_STATUS_ERROR for record in object_schema.all_values.values())
+
+
+def render_object(object_schema, fingerprint):
+
+    done = get_journal().get(get_object_key(object_schema), 'render', fingerprint)
+    if done is not None:
+        print(f"Images of {object_schema.object_name} were rendered by the interrupted run, reusing them")
+        object_schema.render_object_images(done['checksums'])
         return
 
-    confluence_page_url = object_schema.confluence_page_url
-    page_id = confluence.get_confluence_page_id_from_url(confluence_page_url)
+    object_schema.render_object_images()
+
+    if not has_render_errors(object_schema):
+        get_journal().record(get_object_key(object_schema), 'render', fingerprint, {'checksums': get_object_checksums(object_schema)})
+
+
+def sync_attachments(object_schema, fingerprint):
 
-    object_name = object_schema.object_name
+    confluence_page_url = object_schema.confluence_page_url
 
-    unique_filenames = set()
+    image_checksums = {}
     for value in object_schema.all_values.values():
-        filename = value.get_filename()
-        if filename not in unique_filenames:
-            unique_filenames.add(filename)
+        image_checksums[value.get_filename()] = value.checksum
 
-    print(f"Uploading {len(unique_filenames)} images to Confluence page: {page_id}...")
-    counter = 1
-    for filename in unique_filenames:
-        print()
-        print(f"Uploading image {counter} of {len(unique_filenames)}...")
-        confluence.upload_image_to_confluence(confluence_page_url, filename)
-        counter += 1
+    synced_checksums = {os.path.basename(filename): checksum for filename, checksum in image_checksums.items()}
+    done = get_journal().get(get_object_key(object_schema), 'attachments', fingerprint)
+    if done is not None and done['checksums'] == synced_checksums:
+        print(f"Images of {object_schema.object_name} were synced by the interrupted run, skipping")
+        return
 
+    print()
+    print(f"Syncing {len(image_checksums)} images of {object_schema.object_name}...")
+    confluence.sync_page_attachments(confluence_page_url, image_checksums)
 
-def main():
+    get_journal().record(get_object_key(object_schema), 'attachments', fingerprint, {'checksums': synced_checksums})
 
-    os.makedirs(cfg.TEMP_RENDER_FOLDER, exist_ok=True)
 
-    all_schema_files = sorted(glob.glob('./schemas/*.json'), key=lambda x: x.lower())
+def update_object_page(object_schema, fingerprint, record_incremental_state):
 
-    # Debug: Limit to only specific schema files
-    # all_schema_files = [f for f in all_schema_files if 'order' in os.path.basename(f).lower()]
+    done = get_journal().get(get_object_key(object_schema), 'page', fingerprint)
+    if done is not None:
+        print(f"Page of {object_schema.object_name} was updated by the interrupted run, skipping")
+        object_schema.confluence_page_title = done['title']
+    else:
+        update_object_confluence_page(object_schema)
+        get_journal().record(get_object_key(object_schema), 'page', fingerprint, {'title': object_schema.confluence_page_title})
 
-    print(f"Found {len(all_schema_files)} schema files")
-    index = 1
-    for schema_file in all_schema_files:
-        print(f" {index}: {schema_file}")
-        index += 1
+    if not record_incremental_state:
+        return
 
-    object_schemas = []
+    if has_render_errors(object_schema):
+        print(f"Not recording {object_schema.object_name} as up to date, some of its images failed to render")
+        return
 
-    # Phase 1: initialize ObjectSchema objects
+    get_incremental_state().record_object(object_schema.schema_file, fingerprint, get_object_checksums(object_schema))
 
-    print()
-    print('=' * 120)
-    print('Phase 1: Initialize ObjectSchema objects')
-    print('=' * 120)
 
-    counter = 1
-    for schema_file in all_schema_files:
+def reuse_object_page(object_schema):
 
-        print()
-        print(f"Initializing object schema for {schema_file} ({counter} of {len(all_schema_files)})...")
-        counter += 1
+    # the page is not published in this run, the summary page only needs its title
+    print(f"Not publishing the page of {object_schema.object_name} in this run")
+    object_schema.confluence_page_title = confluence.get_confluence_page_title(object_schema.confluence_page_url)
 
-        object_schema = ObjectSchema(schema_file)
-        object_schemas.append(object_schema)
 
-    # Step 2: Render all Figma images for all ObjectSchema objects
+def write_overview_page(confluence_page_url, overview_name, values_array, incremental):
 
-    print()
-    print('=' * 120)
-    print('Phase 2: Render all Figma images for all ObjectSchema objects')
-    print('=' * 120)
-
-    def render_images_with_progress(object_schema_tuple):
-        idx, object_schema, total = object_schema_tuple
-        object_schema.render_object_images()
-        return object_schema.object_name
-
-    total_schemas = len(object_schemas)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-        futures = []
-        for idx, object_schema in enumerate(object_schemas, start=1):
-            futures.append(
-                executor.submit(render_images_with_progress, (idx, object_schema, total_schemas))
+    fingerprint = fingerprint_overview(overview_name, values_array, OVERVIEW_PAGE_TEMPLATES)
+    if incremental and get_incremental_state().get_overview(overview_name) == fingerprint:
+        print(f"Overview page {overview_name} did not change since the last run, skipping it")
+        return
+
+    render_overview_page(confluence_page_url, overview_name, values_array)
+    get_incremental_state().record_overview(overview_name, fingerprint)
+
+
+def build_pipeline(object_schemas, selected_object_schemas, phases, full_width_page_urls, incremental=False, max_workers=None):
+    """Return the pipeline publishing the selected objects and the pages shared by all objects.
+
+    Every object goes through render -> attachment sync -> page update on its own, so the first pages are
+    published while the images of other objects are still rendering. The summary page waits for all object
+    pages (it links to their titles), each overview page waits for all renders, full width comes last.
+    Figma renders are requested per Figma file for all objects at once, before the render and restore tasks needing them.
+    Only the given phases (see PHASES) are run.
+
+    Objects that are not selected, or did not change since their last publication in incremental mode, only
+    get their images back (from disk or the render cache) when the summary or overview pages need them.
+    The same goes for all objects when the render phase is not run. The summary page is always written,
+    overview pages in incremental mode only when something they show changed."""
+
+    pipeline = Pipeline(max_workers or cfg.MAX_THREADS)
+    # the images of the objects are only needed by these phases, full width alone does not need them
+    object_phases = any(phase in phases for phase in ('render', 'attachments', 'pages'))
+    shared_pages = 'summary' in phases or 'overviews' in phases
+    # an object is only recorded as up to date when all of its steps ran
+    record_objects = all(phase in phases for phase in ('render', 'attachments', 'pages'))
+
+    objects = []
+    active_count = 0
+    for object_schema in object_schemas:
+        fingerprint = get_object_fingerprint(object_schema)
+        last_publication = get_incremental_state().get_object(object_schema.schema_file)
+        known_checksums = last_publication['checksums'] if last_publication is not None else None
+
+        active = object_schema in selected_object_schemas
+        if active and incremental and last_publication is not None and last_publication['fingerprint'] == fingerprint:
+            active = False
+        if active:
+            active_count += 1
+        if (active and object_phases) or shared_pages:
+            objects.append((object_schema, fingerprint, known_checksums, active))
+
+    # The frames all objects may render in this run are requested per Figma file up front, in as few calls as
+    # possible; the render or restore task of an object waits for the files it uses, then only downloads its images
+    render_frames = {}
+    prefetch_tasks = {}
+    if not cfg.SKIP_ACTUAL_RENDERING_FOR_DEBUG:
+        for object_schema, fingerprint, known_checksums, active in objects:
+            if active and 'render' in phases:
+                # everything is rendered again, but images rendered by an interrupted run are restored
+                done = get_journal().get(get_object_key(object_schema), 'render', fingerprint)
+                render_frames[object_schema] = get_render_frames(object_schema, done['checksums'] if done is not None else None)
+            else:
+                render_frames[object_schema] = get_render_frames(object_schema, known_checksums)
+
+        node_ids_by_file_key = {}
+        for frames in render_frames.values():
+            for file_key, node_ids in frames.items():
+                node_ids_by_file_key.setdefault(file_key, set()).update(node_ids)
+        for file_key, node_ids in sorted(node_ids_by_file_key.items()):
+            prefetch_tasks[file_key] = pipeline.add_task(
+                f'request renders {file_key}',
+                functools.partial(get_figma().prefetch_renders, file_key, sorted(node_ids)),
+                phase='request renders'
             )
-        for future in concurrent.futures.as_completed(futures):
-            future.result()
 
+    render_tasks = []
+    page_tasks = []
+    for object_schema, fingerprint, known_checksums, active in objects:
+        object_name = object_schema.object_name
+
+        if active and 'render' in phases:
+            render_task = pipeline.add_task(
+                f'render {object_name}',
+                functools.partial(render_object, object_schema, fingerprint),
+                [prefetch_tasks[file_key] for file_key in render_frames.get(object_schema, {})],
+                phase='render'
+            )
+        else:
+            render_task = pipeline.add_task(
+                f'render {object_name}',
+                functools.partial(object_schema.render_object_images, known_checksums),
+                [prefetch_tasks[file_key] for file_key in render_frames.get(object_schema, {})],
+                phase='restore images'
+            )
+        render_tasks.append(render_task)
+        last_task = render_task
+
+        if active and 'attachments' in phases:
+            last_task = pipeline.add_task(
+                f'sync attachments {object_name}',
+                functools.partial(sync_attachments, object_schema, fingerprint),
+                [last_task],
+                phase='attachments'
+            )
 
-    # Step 3: Remove all existing attachments from Confluence pages for all ObjectSchema objects
+        if active and 'pages' in phases:
+            page_tasks.append(pipeline.add_task(
+                f'update page {object_name}',
+                functools.partial(update_object_page, object_schema, fingerprint, record_objects),
+                [last_task],
+                phase='pages'
+            ))
+        elif 'summary' in phases:
+            page_tasks.append(pipeline.add_task(
+                f'reuse page {object_name}',
+                functools.partial(reuse_object_page, object_schema),
+                [last_task],
+                phase='reuse pages'
+            ))
+
+    print(f"Publishing {active_count} of {len(object_schemas)} objects, phases: {', '.join(phases)}")
+
+    publish_tasks = list(page_tasks)
+
+    if 'summary' in phases:
+        publish_tasks.append(pipeline.add_task(
+            'write summary page',
+            functools.partial(write_summary_page, object_schemas),
+            page_tasks,
+            phase='summary'
+        ))
+
+    if 'overviews' in phases:
+        for confluence_page_url, overview_name, values_array in get_overview_pages(object_schemas):
+            publish_tasks.append(pipeline.add_task(
+                f'write overview page {overview_name}',
+                functools.partial(write_overview_page, confluence_page_url, overview_name, values_array, incremental),
+                render_tasks,
+                phase='overviews'
+            ))
+
+    if 'full-width' in phases:
+        # just to make sure all these pages look alike
+        pipeline.add_task(
+            'make pages full width',
+            functools.partial(confluence.make_pages_full_width, full_width_page_urls),
+            publish_tasks,
+            phase='full-width'
+        )
+
+    return pipeline
+
+
+def select_object_schemas(object_schemas, patterns):
+    """Return the objects whose name or schema file name matches one of the glob patterns (case insensitive)"""
+
+    if not patterns:
+        return list(object_schemas)
+
+    selected = []
+    for pattern in patterns:
+        pattern = pattern.lower()
+        matches = [
+            object_schema for object_schema in object_schemas
+            if fnmatch.fnmatch(object_schema.object_name.lower(), pattern)
+            or fnmatch.fnmatch(os.path.splitext(os.path.basename(object_schema.schema_file))[0].lower(), pattern)
+        ]
+        if not matches:
+            raise ValueError(f"No object matches {pattern}")
+        selected.extend(object_schema for object_schema in matches if object_schema not in selected)
+    return selected
+
+
+def create_argument_parser():
+    # the defaults that come from the configuration are filled in by parse_args, so --help works without one
+
+    parser = argparse.ArgumentParser(description='Render the Figma images of all object schemas and publish them to Confluence.')
+    parser.add_argument('--objects', nargs='+', metavar='NAME',
+        help='only publish these objects, by object name or schema file name, glob patterns allowed (e.g. "order*")')
+    parser.add_argument('--phases', nargs='+', choices=PHASES, default=PHASES, metavar='PHASE',
+        help=f'only run these phases: {", ".join(PHASES)} (default: all)')
+    parser.add_argument('--workers', type=int,
+        help='number of pipeline workers (default: MAX_THREADS of the configuration)')
+    parser.add_argument('--figma-workers', type=int,
+        help='Figma API requests in flight (default: FIGMA_MAX_CONCURRENT_REQUESTS of the configuration)')
+    parser.add_argument('--figma-downloads', type=int,
+        help='Figma image downloads in flight (default: FIGMA_MAX_CONCURRENT_DOWNLOADS of the configuration)')
+    parser.add_argument('--incremental', action=argparse.BooleanOptionalAction,
+        help='only publish objects whose schema file or templates changed since the last run (default: INCREMENTAL of the configuration)')
+    parser.add_argument('--no-render-cache', action='store_true',
+        help='render all images again instead of using the render cache')
+    parser.add_argument('--no-ledger', action='store_true',
+        help='compare all pages and attachments with Confluence instead of trusting the publish ledger')
+    parser.add_argument('--restart', action='store_true',
+        help='do not resume an interrupted run, do all steps again')
+    parser.add_argument('--trace', nargs='?', const='', metavar='FILE',
+        help='write a Chrome trace of the run (default: build/trace.json), open it in chrome://tracing or ui.perfetto.dev')
+    parser.add_argument('--plan', action='store_true',
+        help='only print (and write to build/plan.json) the work a run would do, without asking Figma or Confluence')
+    return parser
+
+
+def parse_args(parser, argv):
+    """Parse the command line, options that are not given take their defaults from the configuration"""
+
+    args = parser.parse_args(argv)
+    if args.workers is None:
+        args.workers = cfg.MAX_THREADS
+    if args.figma_workers is None:
+        args.figma_workers = cfg.FIGMA_MAX_CONCURRENT_REQUESTS
+    if args.figma_downloads is None:
+        args.figma_downloads = cfg.FIGMA_MAX_CONCURRENT_DOWNLOADS
+    if args.incremental is None:
+        args.incremental = cfg.INCREMENTAL
+    if args.trace == '':
+        args.trace = os.path.join(cfg.TEMP_RENDER_FOLDER, 'trace.json')
+    return args
+
+
+def write_metrics(pipeline):
+    # pipeline is None when the run failed before it was built
+
+    task_timings = pipeline.task_timings if pipeline is not None else []
+    for timing in task_timings:
+        metrics.record_phase(timing['phase'], timing['start'], timing['end'])
+
+    metrics.write_json(os.path.join(cfg.TEMP_RENDER_FOLDER, 'metrics.json'))
+    metrics.write_prometheus(os.path.join(cfg.TEMP_RENDER_FOLDER, 'metrics.prom'))
+    if cfg.METRICS_TEXTFILE:
+        metrics.write_prometheus(cfg.METRICS_TEXTFILE)
 
     print()
-    print('=' * 120)
-    print('Phase 3: Remove all existing attachments from Confluence pages for all object schemas')
-    print('=' * 120)
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-        list(executor.map(remove_all_existing_attachments, enumerate(object_schemas)))
+    print(f"Metrics written to {os.path.join(cfg.TEMP_RENDER_FOLDER, 'metrics.json')} and metrics.prom")
 
-    # Step 4: Upload images to Confluence pages for all ObjectSchema objects
 
-    print()
-    print('=' * 120)
-    print('Phase 4: Upload images to Confluence pages for all object schemas')
-    print('=' * 120)
+def write_trace(pipeline, trace_filename):
+    # pipeline is None when the run failed before it was built
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-        list(executor.map(upload_images_to_confluence, object_schemas))
+    task_timings = pipeline.task_timings if pipeline is not None else []
+    for timing in task_timings:
+        tracer.add_span(timing['name'], 'pipeline', timing['start'], timing['end'], timing['thread'], {'phase': timing['phase']})
 
-    # Step 5: Update Confluence pages for all ObjectSchema objects
+    tracer.write(trace_filename)
+    print(f"Trace written to {trace_filename}")
 
-    print()
-    print('=' * 120)
-    print('Phase 5: Update Confluence pages for all object schemas')
-    print('=' * 120)
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-        list(executor.map(update_object_confluence_page, object_schemas))
 
-    # Step 6: Write summary page
+def main(argv=None):
 
-    print()
-    print('=' * 120)
-    print('Phase 6: Write summary page')
-    print('=' * 120)
+    parser = create_argument_parser()
+    args = parse_args(parser, argv)
+    figma = get_figma()
+    journal = get_journal()
+    schema_loader = get_schema_loader()
+    metrics.reset()
+    if args.trace:
+        tracer.enable()
+    # keep the order of PHASES whatever the order on the command line
+    phases = [phase for phase in PHASES if phase in args.phases]
+
+    if (args.figma_workers, args.figma_downloads) != (figma.max_concurrent_requests, figma.max_concurrent_downloads):
+        figma.set_concurrency(args.figma_workers, args.figma_downloads)
+    figma.use_render_cache = not args.no_render_cache
+    confluence.set_use_publish_ledger(not args.no_ledger)
+
+    os.makedirs(cfg.TEMP_RENDER_FOLDER, exist_ok=True)
 
-    write_summary_page(object_schemas)
+    # Page metadata and rendered frames are only valid for a single run
+    confluence.clear_page_cache()
+    figma.render_registry.clear()
+    figma.clear_prefetched_renders()
 
-    # Step 7: Write overview pages
+    # Only complete runs (all phases, all objects) are journaled and resumed
+    complete_run = phases == PHASES and not args.objects
+    journal.enabled = complete_run
+    if args.restart:
+        journal.clear()
+    elif complete_run and len(journal) > 0:
+        print(f"Resuming an interrupted run, {len(journal)} steps are already done (use --restart to do them again)")
 
+    # Metrics and trace are also (and especially) written for failed runs, whatever phase failed
+    pipeline = None
+    try:
+        all_schema_files = sorted(glob.glob(os.path.join(cfg.SCHEMAS_FOLDER, '*.json')), key=lambda x: x.lower())
+
+        print(f"Found {len(all_schema_files)} schema files in {cfg.SCHEMAS_FOLDER}")
+
+        # Phase 1: load and validate all schemas, invalid ones (e.g. broken Figma links) stop the run before anything is sent
+
+        print()
+        print('=' * 120)
+        print('Phase 1: Initialize ObjectSchema objects')
+        print('=' * 120)
+
+        with metrics.phase('initialize'), tracer.span('initialize', 'main'):
+            schemas = schema_loader.load(all_schema_files)
+            object_schemas = [ObjectSchema(schema_file, schemas[schema_file]) for schema_file in all_schema_files]
+
+        print(f"Loaded {len(object_schemas)} object schemas, {schema_loader.cached_count} of them unchanged since the last run")
+
+        # All objects are loaded anyway, the summary and overview pages show all of them
+        try:
+            selected_object_schemas = select_object_schemas(object_schemas, args.objects)
+        except ValueError as e:
+            parser.error(str(e))
+
+        if args.plan:
+            fingerprints = {object_schema: get_object_fingerprint(object_schema) for object_schema in object_schemas}
+            planner = RunPlanner(figma, confluence, get_incremental_state(), journal)
+            plan = planner.plan(object_schemas, selected_object_schemas, phases, fingerprints, args.incremental, not args.no_render_cache)
+            print_plan(plan)
+
+            plan_filename = os.path.join(cfg.TEMP_RENDER_FOLDER, 'plan.json')
+            with open(plan_filename, 'w', encoding='utf-8') as f:
+                json.dump(plan, f, indent=2)
+            print()
+            print(f"Plan written to {plan_filename}")
+            return plan
+
+        # Phase 2: render, sync and publish every object as soon as the work it depends on is done
+
+        print()
+        print('=' * 120)
+        print('Phase 2: Render Figma images and update Confluence pages')
+        print('=' * 120)
+
+        published_page_urls = []
+        if 'pages' in phases:
+            published_page_urls.extend(object_schema.confluence_page_url for object_schema in selected_object_schemas)
+        if 'summary' in phases:
+            published_page_urls.append(cfg.CONFLUENCE_SUMMARY_PAGE_URL)
+        if 'overviews' in phases:
+            published_page_urls.extend(get_overview_page_urls())
+
+        # Full width applies to all pages of the selected objects and the shared pages, whatever else is run
+        full_width_page_urls = []
+        if 'full-width' in phases:
+            full_width_page_urls.extend(object_schema.confluence_page_url for object_schema in selected_object_schemas)
+            full_width_page_urls.append(cfg.CONFLUENCE_SUMMARY_PAGE_URL)
+            full_width_page_urls.extend(get_overview_page_urls())
+
+        # Read all pages this run may touch in a few bulk requests, page updates then only need to write;
+        # the summary page needs the titles of all object pages
+        prefetch_page_urls = published_page_urls + full_width_page_urls
+        if 'summary' in phases:
+            prefetch_page_urls.extend(object_schema.confluence_page_url for object_schema in object_schemas)
+        elif 'attachments' in phases:
+            prefetch_page_urls.extend(object_schema.confluence_page_url for object_schema in selected_object_schemas)
+        with metrics.phase('prefetch'), tracer.span('prefetch', 'main'):
+            confluence.prefetch_pages(list(dict.fromkeys(prefetch_page_urls)))
+
+        pipeline = build_pipeline(object_schemas, selected_object_schemas, phases, full_width_page_urls, args.incremental, args.workers)
+        pipeline.run()
+    finally:
+        # a plan sends nothing, its metrics would only replace those of the last run
+        if not args.plan:
+            write_metrics(pipeline)
+        if args.trace:
+            write_trace(pipeline, args.trace)
+
+    if complete_run:
+        journal.clear()
+
+    figma_stats = figma.get_request_stats()
     print()
-    print('=' * 120)
-    print('Phase 7: Write overview pages')
-    print('=' * 120)
+    print(f"Figma API: {figma_stats['throttled']} requests throttled, {figma_stats['retried']} retried, final rate {figma_stats['rate_per_minute']} requests per minute, "
+          f"{figma_stats['shared_renders']} images shared with other records rendering the same frame")
 
-    write_overview_pages(object_schemas)
+    confluence_stats = confluence.get_request_stats()
+    print()
+    print(f"Confluence: {confluence_stats['requests']} requests, {confluence_stats['throttled']} throttled, final concurrency limit {confluence_stats['concurrency_limit']}")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+import re
+import json
+import time
+import threading
+import contextlib
+from urllib.parse import urlparse
+
+from util import write_file_atomically
+
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Path segments that are ids (page ids, Figma file keys, image ids) are replaced so requests group by endpoint
+_ID_SEGMENT = re.compile(r'^(\d+|(?=.*\d)[A-Za-z0-9%:_-]{6,})$')
+
+METRIC_PREFIX = 'mpt_objects_inventory'
+
+
+def get_endpoint(method, url):
+    """Return the endpoint of a request, e.g. 'GET /rest/api/content/{id}/child/attachment'"""
+
+    path = urlparse(url).path
+    segments = ['{id}' if _ID_SEGMENT.match(segment) else segment for segment in path.split('/')]
+    return f"{method} {'/'.join(segments)}"
+
+
+class Metrics:
+    """Thread-safe collector of the metrics of a run: phase timings, requests by endpoint and status,
+    request latency histograms, retries and bytes sent and received, per service (figma, confluence)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+
+        with self._lock:
+            self._started_at = time.time()
+            self._start = time.monotonic()
+            self._phases = {}
+            self._requests = {}
+            self._latencies = {}
+            self._retries = {}
+            self._bytes = {}
+
+
+    def instrument_session(self, session, service):
+        """Record every response received by a requests session"""
+
+        def on_response(response, *args, **kwargs):
+            self._on_response(service, response)
+        session.hooks['response'].append(on_response)
+
+
+    def _on_response(self, service, response):
+
+        request = response.request
+        bytes_sent = request.headers.get('Content-Length')
+        if bytes_sent is None:
+            bytes_sent = len(request.body) if isinstance(request.body, (bytes, str)) else 0
+        # the body may not be read yet (streamed downloads), rely on what the server announced
+        bytes_received = response.headers.get('Content-Length', 0)
+
+        # Attempts retried inside urllib3 (Confluence) do not come back as responses of their own
+        retries = getattr(response.raw, 'retries', None)
+        retry_count = len(retries.history) if retries is not None else 0
+
+        self.record_request(
+            service,
+            get_endpoint(request.method, request.url),
+            response.status_code,
+            response.elapsed.total_seconds(),
+            int(bytes_sent),
+            int(bytes_received),
+            retry_count
+        )
+
+
+    def record_request(self, service, endpoint, status, latency, bytes_sent=0, bytes_received=0, retries=0):
+
+        with self._lock:
+            key = (service, endpoint, str(status))
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+            histogram = self._latencies.setdefault((service, endpoint), {
+                'buckets': [0] * len(LATENCY_BUCKETS),
+                'sum': 0.0,
+                'count': 0,
+            })
+            for index, upper_bound in enumerate(LATENCY_BUCKETS):
+                if latency <= upper_bound:
+                    histogram['buckets'][index] += 1
+                    break
+            histogram['sum'] += latency
+            histogram['count'] += 1
+
+            service_bytes = self._bytes.setdefault(service, {'sent': 0, 'received': 0})
+            service_bytes['sent'] += bytes_sent
+            service_bytes['received'] += bytes_received
+
+            if retries:
+                self._retries[service] = self._retries.get(service, 0) + retries
+
+
+    def record_retry(self, service):
+
+        with self._lock:
+            self._retries[service] = self._retries.get(service, 0) + 1
+
+
+    def record_phase(self, phase, start, end):
+        """Record work of a phase done from start to end (time.monotonic), a phase may be recorded many times and concurrently"""
+
+        with self._lock:
+            phase_metrics = self._phases.setdefault(phase, {
+                'start': start,
+                'end': end,
+                'count': 0,
+                'busy_seconds': 0.0,
+            })
+            phase_metrics['start'] = min(phase_metrics['start'], start)
+            phase_metrics['end'] = max(phase_metrics['end'], end)
+            phase_metrics['count'] += 1
+            phase_metrics['busy_seconds'] += end - start
+
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record_phase(phase, start, time.monotonic())
+
+
+    def report(self):
+        """Return the metrics as a dict"""
+
+        with self._lock:
+            return {
+                'started_at': self._started_at,
+                'duration_seconds': round(time.monotonic() - self._start, 3),
+                'phases': {
+                    phase: {
+                        # wall time from the first start to the last end, the work may overlap with other phases
+                        'seconds': round(phase_metrics['end'] - phase_metrics['start'], 3),
+                        'busy_seconds': round(phase_metrics['busy_seconds'], 3),
+                        'count': phase_metrics['count'],
+                    }
+                    for phase, phase_metrics in self._phases.items()
+                },
+                'requests': [
+                    {'service': service, 'endpoint': endpoint, 'status': status, 'count': count}
+                    for (service, endpoint, status), count in sorted(self._requests.items())
+                ],
+                'latency_buckets': list(LATENCY_BUCKETS),
+                'latencies': [
+                    {
+                        'service': service,
+                        'endpoint': endpoint,
+                        'buckets': list(histogram['buckets']),
+                        'sum': round(histogram['sum'], 3),
+                        'count': histogram['count'],
+                    }
+                    for (service, endpoint), histogram in sorted(self._latencies.items())
+                ],
+                'retries': dict(self._retries),
+                'bytes': {service: dict(service_bytes) for service, service_bytes in self._bytes.items()},
+            }
+
+
+    def write_json(self, filename):
+        write_file_atomically(filename, json.dumps(self.report(), indent=2))
+
+
+    def write_prometheus(self, filename):
+        """Write the metrics in the Prometheus text format, e.g. for the textfile collector of the node exporter"""
+
+        report = self.report()
+        lines = []
+
+        def add(name, metric_type, help_text, samples):
+            lines.append(f'# HELP {METRIC_PREFIX}_{name} {help_text}')
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} {metric_type}')
+            for labels, value in samples:
+                label_text = ','.join(f'{label}="{_escape_label(label_value)}"' for label, label_value in labels)
+                suffix = '{' + label_text + '}' if labels else ''
+                lines.append(f'{METRIC_PREFIX}_{name}{suffix} {value}')
+
+        add('run_timestamp_seconds', 'gauge', 'Start of the run.', [((), report['started_at'])])
+        add('run_duration_seconds', 'gauge', 'Wall time of the run.', [((), report['duration_seconds'])])
+        add('phase_duration_seconds', 'gauge', 'Wall time of a phase.',
+            [((('phase', phase),), phase_metrics['seconds']) for phase, phase_metrics in report['phases'].items()])
+        add('phase_busy_seconds', 'gauge', 'Time spent on all work of a phase.',
+            [((('phase', phase),), phase_metrics['busy_seconds']) for phase, phase_metrics in report['phases'].items()])
+        add('phase_tasks', 'gauge', 'Number of tasks of a phase.',
+            [((('phase', phase),), phase_metrics['count']) for phase, phase_metrics in report['phases'].items()])
+        add('requests_total', 'counter', 'HTTP requests by endpoint and status.',
+            [((('service', r['service']), ('endpoint', r['endpoint']), ('status', r['status'])), r['count']) for r in report['requests']])
+
+        lines.append(f'# HELP {METRIC_PREFIX}_request_duration_seconds HTTP request latency.')
+        lines.append(f'# TYPE {METRIC_PREFIX}_request_duration_seconds histogram')
+        for latency in report['latencies']:
+            labels = f'service="{latency["service"]}",endpoint="{_escape_label(latency["endpoint"])}"'
+            cumulative = 0
+            for upper_bound, count in zip(LATENCY_BUCKETS, latency['buckets']):
+                cumulative += count
+                lines.append(f'{METRIC_PREFIX}_request_duration_seconds_bucket{{{labels},le="{upper_bound}"}} {cumulative}')
+            lines.append(f'{METRIC_PREFIX}_request_duration_seconds_bucket{{{labels},le="+Inf"}} {latency["count"]}')
+            lines.append(f'{METRIC_PREFIX}_request_duration_seconds_sum{{{labels}}} {latency["sum"]}')
+            lines.append(f'{METRIC_PREFIX}_request_duration_seconds_count{{{labels}}} {latency["count"]}')
+
+        add('request_retries_total', 'counter', 'Retried HTTP requests.',
+            [((('service', service),), count) for service, count in report['retries'].items()])
+        add('bytes_sent_total', 'counter', 'Bytes of HTTP request bodies.',
+            [((('service', service),), service_bytes['sent']) for service, service_bytes in report['bytes'].items()])
+        add('bytes_received_total', 'counter', 'Bytes of HTTP response bodies.',
+            [((('service', service),), service_bytes['received']) for service, service_bytes in report['bytes'].items()])
+
+        write_file_atomically(filename, '\n'.join(lines) + '\n')
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Shared by the Figma and Confluence clients and main
+metrics = Metrics()
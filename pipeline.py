@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import time
+import threading
+import concurrent.futures
+
+
+class PipelineError(Exception):
+    pass
+
+
+class Pipeline:
+    """Runs a graph of tasks on a thread pool, every task starts as soon as the tasks it depends on are done.
+
+    When a task fails, the tasks depending on it (directly or not) are skipped while all other tasks still run;
+    run() raises a PipelineError listing the failures at the end. The start and end (time.monotonic) of every
+    task that ran are kept in task_timings."""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.task_timings = []
+        self._tasks = {}
+
+
+    def add_task(self, name, function, dependencies=(), phase=None):
+        """Add a task calling function() once all tasks named in dependencies are done, returns the name.
+
+        The phase names the kind of work the task does (e.g. render), for reporting only."""
+
+        if name in self._tasks:
+            raise ValueError(f'Task {name} already exists')
+        for dependency in dependencies:
+            if dependency not in self._tasks:
+                raise ValueError(f'Task {name} depends on unknown task {dependency}')
+
+        self._tasks[name] = {
+            'function': function,
+            'dependencies': set(dependencies),
+            'phase': phase or name,
+        }
+        return name
+
+
+    def run(self):
+        """Run all tasks, returns the dict task name -> result"""
+
+        remaining = {name: set(task['dependencies']) for name, task in self._tasks.items()}
+        dependents = {name: [] for name in self._tasks}
+        for name, task in self._tasks.items():
+            for dependency in task['dependencies']:
+                dependents[dependency].append(name)
+
+        results = {}
+        failures = {}
+        skipped = set()
+        lock = threading.Lock()
+        all_done = threading.Event()
+        pending_count = [len(self._tasks)]
+
+        if not self._tasks:
+            return results
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+
+        def finish(name):
+            # called with the lock held, returns the tasks that became ready
+            pending_count[0] -= 1
+            ready = []
+            for dependent in dependents[name]:
+                if dependent in skipped:
+                    continue
+                if name in failures or name in skipped:
+                    skip(dependent)
+                    continue
+                remaining[dependent].discard(name)
+                if not remaining[dependent]:
+                    ready.append(dependent)
+            if pending_count[0] == 0:
+                all_done.set()
+            return ready
+
+        def skip(name):
+            skipped.add(name)
+            print(f'Skipping {name}, a task it depends on failed')
+            for ready_name in finish(name):
+                submit(ready_name)
+
+        def run_task(name):
+            start = time.monotonic()
+            try:
+                result = self._tasks[name]['function']()
+                error = None
+            except Exception as e:
+                result = None
+                error = e
+                print(f'Task {name} failed: {e}')
+            end = time.monotonic()
+
+            with lock:
+                self.task_timings.append({
+                    'name': name,
+                    'phase': self._tasks[name]['phase'],
+                    'start': start,
+                    'end': end,
+                    'thread': threading.get_ident(),
+                    'failed': error is not None,
+                })
+                if error is None:
+                    results[name] = result
+                else:
+                    failures[name] = error
+                ready = finish(name)
+            for ready_name in ready:
+                submit(ready_name)
+
+        def submit(name):
+            executor.submit(run_task, name)
+
+        with lock:
+            initial = [name for name, dependencies in remaining.items() if not dependencies]
+        for name in initial:
+            submit(name)
+
+        all_done.wait()
+        executor.shutdown(wait=True)
+
+        if failures:
+            raise PipelineError(
+                f'{len(failures)} tasks failed, {len(skipped)} skipped: '
+                + ', '.join(f'{name} ({error})' for name, error in failures.items())
+            ) from next(iter(failures.values()))
+
+        return results
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+import os
+import math
+
+from config import cfg
+from util import file_sha256
+from confluence import get_ledger, CONFLUENCE_PAGES_PER_SEARCH
+from figma import FIGMA_MAX_IDS_PER_REQUEST
+from renderers.overview import get_overview_pages, get_overview_page_urls
+
+
+class RunPlanner:
+    """Works out what a run would do, from local state only: the render cache, the publish ledger,
+    the incremental state and the journal of an interrupted run. Neither Figma nor Confluence is asked.
+
+    Without asking Figma we cannot know which Figma files changed, so images are assumed to be unchanged
+    when the render cache still has their last render, and to need a render otherwise. New renders are
+    assumed to differ from the published images, so the estimated uploads and page updates are an upper bound."""
+
+    def __init__(self, figma, confluence, incremental_state, journal):
+        self.figma = figma
+        self.confluence = confluence
+        self.incremental_state = incremental_state
+        self.journal = journal
+
+
+    def _plan_images(self, object_schema, render, use_render_cache, journal_checksums):
+        # Returns the list of {unique_key, filename, checksum (None if unknown), render, file_key, frame, bytes} of an object
+
+        last_publication = self.incremental_state.get_object(object_schema.schema_file)
+        known_checksums = journal_checksums or (last_publication['checksums'] if last_publication is not None else {})
+        average_size = self.figma.render_cache.get_average_size()
+
+        images = []
+        for unique_key, record in object_schema.all_values.items():
+            filename = record.get_image_filename(object_schema.object_render_folder)
+            checksum = known_checksums.get(unique_key)
+            size = self.figma.render_cache.get_size_by_checksum(checksum) if checksum is not None else None
+
+            file_key = None
+            frame = None
+            if record.figma_link is not None:
+                try:
+                    file_key, node_id = self.figma._parse_figma_url(record.figma_link)
+                    frame = (file_key, self.figma._get_node_key(node_id))
+                except ValueError:
+                    # fails without asking Figma, the error image is uploaded instead
+                    filename = object_schema.image_rendering_error
+
+            if file_key is None:
+                needs_render = False
+                checksum = file_sha256(filename)
+                size = os.path.getsize(filename)
+            elif journal_checksums is not None:
+                # restored from the render cache, whatever the options
+                needs_render = size is None
+            elif render and not use_render_cache:
+                needs_render = True
+            else:
+                needs_render = size is None
+
+            if needs_render:
+                checksum = None
+                size = average_size
+            images.append({
+                'unique_key': unique_key,
+                'filename': os.path.basename(filename),
+                'checksum': checksum,
+                'render': needs_render,
+                'file_key': file_key,
+                'frame': frame,
+                'bytes': size,
+            })
+        return images
+
+
+    def _plan_attachments(self, page_url, images):
+        # Returns (uploads, deletes, requests, bytes) of syncing a page with the given images
+
+        page_id = self.confluence.get_confluence_page_id_from_url(page_url)
+        published = get_ledger().get_attachments(page_id)
+
+        local = {}
+        for image in images:
+            local[image['filename']] = image
+
+        if published is not None and set(published) == set(local) and all(
+            image['checksum'] is not None and published[filename] == image['checksum']
+            for filename, image in local.items()
+        ):
+            return [], [], 0, 0
+
+        uploads = [
+            filename for filename, image in local.items()
+            if published is None or image['checksum'] is None or published.get(filename) != image['checksum']
+        ]
+        deletes = [filename for filename in (published or {}) if filename not in local]
+        # an upload replacing an attachment we published before deletes the old one first
+        replaced = [filename for filename in uploads if published is not None and filename in published]
+        # one listing of the attachments, batched uploads, two requests (current, trashed) per deleted attachment
+        requests = (
+            1 + math.ceil(len(uploads) / cfg.CONFLUENCE_ATTACHMENTS_PER_REQUEST)
+            + 2 * len(deletes) + 2 * len(replaced)
+        )
+        return uploads, deletes, requests, sum(local[filename]['bytes'] for filename in uploads)
+
+
+    def _plan_page_update(self, page_url, changed):
+        # Returns the number of requests of a page update: none when we published it before and nothing changed
+
+        page_id = self.confluence.get_confluence_page_id_from_url(page_url)
+        if not changed and get_ledger().get_page(page_id) is not None:
+            return 0
+        # read the current body, write the new one
+        return 2
+
+
+    def plan(self, object_schemas, selected_object_schemas, phases, fingerprints, incremental, use_render_cache=True):
+        """Return the plan of a run as a dict, see main.build_pipeline for what a run does"""
+
+        object_phases = any(phase in phases for phase in ('render', 'attachments', 'pages'))
+        shared_pages = 'summary' in phases or 'overviews' in phases
+        figma_file_keys = set()
+        figma_requests = 0
+        figma_bytes = 0
+        confluence_requests = 0
+        confluence_bytes = 0
+        published_page_urls = []
+        any_change = False
+
+        objects = []
+        images_by_unique_key = {}
+        # a frame is rendered once per run, however many records point at it
+        rendered_frames = set()
+        renders_by_file_key = {}
+        for object_schema in object_schemas:
+            fingerprint = fingerprints[object_schema]
+            key = os.path.basename(object_schema.schema_file)
+            last_publication = self.incremental_state.get_object(object_schema.schema_file)
+            unchanged = last_publication is not None and last_publication['fingerprint'] == fingerprint
+
+            active = object_schema in selected_object_schemas and not (incremental and unchanged)
+            if not (active and object_phases) and not shared_pages:
+                continue
+
+            journal_render = self.journal.get(key, 'render', fingerprint) if active else None
+            images = self._plan_images(
+                object_schema,
+                active and 'render' in phases,
+                use_render_cache,
+                journal_render['checksums'] if journal_render is not None else None
+            )
+            for image in images:
+                images_by_unique_key[(object_schema, image['unique_key'])] = image
+
+            # Images rendered or restored in this run are requested per Figma file for all objects at once,
+            # in batches of FIGMA_MAX_IDS_PER_REQUEST; the version of every such file is asked once per run
+            for image in images:
+                if image['render'] and image['frame'] not in rendered_frames:
+                    rendered_frames.add(image['frame'])
+                    renders_by_file_key.setdefault(image['file_key'], []).append(image)
+                    figma_file_keys.add(image['file_key'])
+            if active and 'render' in phases and journal_render is None:
+                # all frames of the object are asked for, the render cache is looked up with the file versions
+                figma_file_keys.update(image['file_key'] for image in images if image['file_key'] is not None)
+
+            changed = not unchanged or any(image['render'] for image in images)
+            object_plan = {
+                'name': object_schema.object_name,
+                'schema_file': key,
+                'publish': active,
+                'changed': changed,
+                'renders': [image['unique_key'] for image in images if image['render']],
+                'attachment_uploads': [],
+                'attachment_deletes': [],
+                'page_update': False,
+            }
+
+            if active and 'attachments' in phases and self.journal.get(key, 'attachments', fingerprint) is None:
+                uploads, deletes, requests, upload_bytes = self._plan_attachments(object_schema.confluence_page_url, images)
+                object_plan['attachment_uploads'] = uploads
+                object_plan['attachment_deletes'] = deletes
+                confluence_requests += requests
+                confluence_bytes += upload_bytes
+
+            if active and 'pages' in phases:
+                published_page_urls.append(object_schema.confluence_page_url)
+                if self.journal.get(key, 'page', fingerprint) is None:
+                    requests = self._plan_page_update(object_schema.confluence_page_url, changed)
+                    object_plan['page_update'] = requests > 0
+                    confluence_requests += requests
+
+            any_change = any_change or (active and changed)
+            objects.append(object_plan)
+
+        for file_key, file_renders in renders_by_file_key.items():
+            figma_requests += math.ceil(len(file_renders) / FIGMA_MAX_IDS_PER_REQUEST) + len(file_renders)
+            figma_bytes += sum(image['bytes'] for image in file_renders)
+        figma_requests += len(figma_file_keys)
+
+        shared_plans = []
+        if 'summary' in phases:
+            published_page_urls.append(cfg.CONFLUENCE_SUMMARY_PAGE_URL)
+            requests = self._plan_page_update(cfg.CONFLUENCE_SUMMARY_PAGE_URL, any_change)
+            confluence_requests += requests
+            shared_plans.append({
+                'name': 'Summary',
+                'page_update': requests > 0,
+                'attachment_uploads': [],
+            })
+
+        if 'overviews' in phases:
+            for confluence_page_url, overview_name, values_array in get_overview_pages(object_schemas):
+                published_page_urls.append(confluence_page_url)
+                changed_values = [
+                    value for value in values_array
+                    if value is not None and images_by_unique_key.get((value.parent, value.unique_key), {}).get('render', False)
+                ]
+                shared_plan = {
+                    'name': overview_name,
+                    'page_update': False,
+                    'attachment_uploads': [value.parent.object_name + ': ' + value.unique_key for value in changed_values],
+                }
+                if changed_values or not incremental:
+                    page_requests = self._plan_page_update(confluence_page_url, bool(changed_values))
+                    shared_plan['page_update'] = page_requests > 0
+                    confluence_requests += page_requests
+                if changed_values:
+                    # a changed image replaces its attachment: two requests (current, trashed) delete the old one
+                    confluence_requests += (
+                        1 + math.ceil(len(changed_values) / cfg.CONFLUENCE_ATTACHMENTS_PER_REQUEST)
+                        + 2 * len(changed_values)
+                    )
+                    confluence_bytes += sum(images_by_unique_key[(value.parent, value.unique_key)]['bytes'] for value in changed_values)
+                shared_plans.append(shared_plan)
+
+        # full width applies to the pages of the selected objects and the shared pages, whatever else is run
+        full_width_page_urls = []
+        if 'full-width' in phases:
+            full_width_page_urls.extend(object_schema.confluence_page_url for object_schema in selected_object_schemas)
+            full_width_page_urls.append(cfg.CONFLUENCE_SUMMARY_PAGE_URL)
+            full_width_page_urls.extend(get_overview_page_urls())
+
+        # the pages are read in bulk before anything is written
+        confluence_requests += math.ceil(len(set(published_page_urls + full_width_page_urls)) / CONFLUENCE_PAGES_PER_SEARCH)
+
+        if 'full-width' in phases:
+            # only pages we never published may still need their appearance property written
+            for page_url in full_width_page_urls:
+                if get_ledger().get_page(self.confluence.get_confluence_page_id_from_url(page_url)) is None:
+                    confluence_requests += 1
+
+        return {
+            'phases': phases,
+            'incremental': incremental,
+            'objects': objects,
+            'shared_pages': shared_plans,
+            'estimate': {
+                'figma_renders': len(rendered_frames),
+                'figma_requests': figma_requests,
+                'figma_download_bytes': figma_bytes,
+                'attachment_uploads': sum(len(object_plan['attachment_uploads']) for object_plan in objects)
+                    + sum(len(shared_plan['attachment_uploads']) for shared_plan in shared_plans),
+                'attachment_deletes': sum(len(object_plan['attachment_deletes']) for object_plan in objects),
+                'page_updates': sum(1 for plan in objects + shared_plans if plan['page_update']),
+                'confluence_requests': confluence_requests,
+                'confluence_upload_bytes': confluence_bytes,
+            },
+        }
+
+
+def print_plan(plan):
+
+    print()
+    print(f"Plan ({'incremental' if plan['incremental'] else 'full'} run, phases: {', '.join(plan['phases'])}):")
+    for object_plan in plan['objects']:
+        if not object_plan['publish'] and not object_plan['renders']:
+            continue
+        print(f"  {object_plan['name']}: {len(object_plan['renders'])} renders, "
+              f"{len(object_plan['attachment_uploads'])} uploads, {len(object_plan['attachment_deletes'])} deletes, "
+              f"{'page update' if object_plan['page_update'] else 'no page update'}")
+    for shared_plan in plan['shared_pages']:
+        print(f"  {shared_plan['name']} page: {len(shared_plan['attachment_uploads'])} uploads, "
+              f"{'page update' if shared_plan['page_update'] else 'no page update'}")
+
+    estimate = plan['estimate']
+    print()
+    print(f"Figma: {estimate['figma_renders']} renders, about {estimate['figma_requests']} requests, {estimate['figma_download_bytes'] / 1024 / 1024:.1f} MB to download")
+    print(f"Confluence: {estimate['attachment_uploads']} uploads, {estimate['attachment_deletes']} deletes, {estimate['page_updates']} page updates, "
+          f"about {estimate['confluence_requests']} requests, {estimate['confluence_upload_bytes'] / 1024 / 1024:.1f} MB to upload")
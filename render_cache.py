@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+from util import file_sha256, copy_file_atomically, write_json_atomically
+
+
+class RenderCache:
+    """Persistent on-disk cache of rendered Figma images with size-bounded LRU eviction.
+
+    Entries are addressed by a hash of (file key, node id, scale, format, file version), so an entry
+    can only be served as long as the Figma file has not changed since it was rendered."""
+
+    def __init__(self, cache_folder, max_bytes):
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self._index_filename = os.path.join(cache_folder, 'index.json')
+        self._lock = threading.Lock()
+        self._entries = {}
+
+        if os.path.exists(self._index_filename):
+            try:
+                with open(self._index_filename, 'r', encoding='utf-8') as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f'Ignoring unreadable render cache index {self._index_filename}: {e}')
+                self._entries = {}
+
+
+    def make_key(self, file_key, node_id, scale, image_format, file_version):
+        raw_key = '|'.join([file_key, node_id, str(scale), image_format, str(file_version)])
+        return hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
+
+
+    def _get_cached_filename(self, key):
+        return os.path.join(self.cache_folder, key[:2], key)
+
+
+    def get(self, key, out_filename):
+        """Copy the cached image to out_filename, returns its SHA-256 checksum or None if there is no such entry"""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            cached_filename = self._get_cached_filename(key)
+            if entry is None:
+                return None
+            if not os.path.exists(cached_filename):
+                del self._entries[key]
+                return None
+
+            copy_file_atomically(cached_filename, out_filename)
+            entry['last_used'] = time.time()
+
+            if 'sha256' not in entry:
+                entry['sha256'] = file_sha256(cached_filename)
+            return entry['sha256']
+
+
+    def contains(self, key):
+        """Whether get() would serve the entry, without copying it"""
+
+        with self._lock:
+            return key in self._entries and os.path.exists(self._get_cached_filename(key))
+
+
+    def contains_checksum(self, checksum):
+        """Whether get_by_checksum() would serve an image with the given SHA-256 checksum, without copying it"""
+
+        with self._lock:
+            return any(
+                entry.get('sha256') == checksum and os.path.exists(self._get_cached_filename(key))
+                for key, entry in self._entries.items()
+            )
+
+
+    def get_by_checksum(self, checksum, out_filename):
+        """Copy a cached image with the given SHA-256 checksum to out_filename, returns False if there is none"""
+
+        with self._lock:
+            for key, entry in self._entries.items():
+                if entry.get('sha256') != checksum:
+                    continue
+                cached_filename = self._get_cached_filename(key)
+                if not os.path.exists(cached_filename):
+                    continue
+
+                copy_file_atomically(cached_filename, out_filename)
+                entry['last_used'] = time.time()
+                return True
+
+        return False
+
+
+    def get_size_by_checksum(self, checksum):
+        """Return the size of a cached image with the given SHA-256 checksum, or None if there is none"""
+
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.get('sha256') == checksum:
+                    return entry['size']
+        return None
+
+
+    def get_average_size(self):
+
+        with self._lock:
+            if not self._entries:
+                return 0
+            return sum(entry['size'] for entry in self._entries.values()) // len(self._entries)
+
+
+    def put(self, key, filename, checksum):
+        """Store a copy of filename (with the given SHA-256 checksum) under the key, evicting the least recently used entries if needed"""
+
+        size = os.path.getsize(filename)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            cached_filename = self._get_cached_filename(key)
+            os.makedirs(os.path.dirname(cached_filename), exist_ok=True)
+            shutil.copyfile(filename, cached_filename)
+            self._entries[key] = {
+                'size': size,
+                'last_used': time.time(),
+                'sha256': checksum,
+            }
+            self._evict()
+
+
+    def _evict(self):
+
+        total_size = sum(entry['size'] for entry in self._entries.values())
+        if total_size <= self.max_bytes:
+            return
+
+        for key, entry in sorted(self._entries.items(), key=lambda item: item[1]['last_used']):
+            cached_filename = self._get_cached_filename(key)
+            if os.path.exists(cached_filename):
+                os.remove(cached_filename)
+            del self._entries[key]
+            total_size -= entry['size']
+            if total_size <= self.max_bytes:
+                break
+
+
+    def save(self):
+
+        with self._lock:
+            write_json_atomically(self._index_filename, self._entries)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import threading
+
+
+class _Render:
+    # One Figma frame rendered in this run: set once by the thread rendering it, waited for by all others
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.filename = None
+        self.result = None
+
+
+class RenderRegistry:
+    """Run-wide registry of the Figma frames rendered so far, keyed by (file key, node key).
+
+    The same frame is often referenced by several objects, or by several roles of the same object.
+    The first render job of a frame claims it and renders it, every other job of the same frame waits
+    for that render and copies its image, so each frame is rendered and downloaded once per run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._renders = {}
+        self.shared_count = 0
+
+
+    def claim(self, frame_key):
+        """Return (render, owner): owner is True if the caller has to render the frame and settle() it,
+        otherwise the render belongs to another job and wait() returns its outcome"""
+
+        with self._lock:
+            render = self._renders.get(frame_key)
+            if render is not None:
+                self.shared_count += 1
+                return render, False
+            render = _Render()
+            self._renders[frame_key] = render
+            return render, True
+
+
+    def settle(self, render, filename, result):
+        """Publish the outcome of a claimed render: the rendered file and its checksum, or the exception that prevented rendering"""
+
+        render.filename = filename
+        render.result = result
+        render.done.set()
+
+
+    def wait(self, render):
+        """Wait for a render claimed by another job, returns (filename, checksum or exception)"""
+
+        render.done.wait()
+        return render.filename, render.result
+
+
+    def clear(self):
+
+        with self._lock:
+            self._renders = {}
+            self.shared_count = 0
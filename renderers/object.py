@@ -5,13 +5,24 @@ import os
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from config import Config
+from config import cfg
 from confluence import Confluence
-from util import populate_template, populate_multitable_template, read_file
+from util import populate_template, populate_multitable_template
+from templates import get_template, get_template_filename
+from tracing import tracer
 
-cfg = Config()
 confluence = Confluence()
 
+# Templates an object page is made of, an object has to be republished when one of them changes
+OBJECT_PAGE_TEMPLATES = [
+    get_template_filename("confluence-templates/object-page.html"),
+    get_template_filename("confluence-templates/roles-table.html"),
+    get_template_filename("confluence-templates/single-table.html"),
+    get_template_filename("confluence-templates/multitable.html"),
+    get_template_filename("confluence-templates/multitable-row.html"),
+]
+
+@tracer.traced('renderers')
 def update_object_confluence_page(object_schema):
 
     confluence_page_url = object_schema.confluence_page_url
@@ -24,9 +35,9 @@ def update_object_confluence_page(object_schema):
     page_id = confluence.get_confluence_page_id_from_url(confluence_page_url)
     object_name = object_schema.object_name
 
-    page_template = read_file("confluence-templates/object-page.html")
-    roles_table_template = read_file("confluence-templates/roles-table.html")
-    single_table_template = read_file("confluence-templates/single-table.html")
+    page_template = get_template("confluence-templates/object-page.html")
+    roles_table_template = get_template("confluence-templates/roles-table.html")
+    single_table_template = get_template("confluence-templates/single-table.html")
 
     WHITE = '#ffffff'
     LIGHT_BLUE = '#eaf4ff'
@@ -155,8 +166,8 @@ def update_object_confluence_page(object_schema):
         }
     )
 
-    multitable_template = read_file("confluence-templates/multitable.html")
-    multitable_row_template = read_file("confluence-templates/multitable-row.html")
+    multitable_template = get_template("confluence-templates/multitable.html")
+    multitable_row_template = get_template("confluence-templates/multitable-row.html")
 
     email_notifications_vendor_table = populate_multitable_template(
         multitable_template,
@@ -6,15 +6,24 @@ import shutil
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from config import Config
+from config import cfg
 from confluence import Confluence
-from util import populate_template, populate_multitable_template, read_file
+from util import populate_template, populate_multitable_template
+from templates import get_template, get_template_filename
+from tracing import tracer
 
-cfg = Config()
 confluence = Confluence()
 
+# Templates an overview page is made of
+OVERVIEW_PAGE_TEMPLATES = [
+    get_template_filename("confluence-templates/overview-page.html"),
+    get_template_filename("confluence-templates/multitable.html"),
+    get_template_filename("confluence-templates/multitable-row.html"),
+]
 
 
+
+@tracer.traced('renderers')
 def render_overview_page(confluence_page_url, overview_name, values_array):
 
     print()
@@ -46,14 +55,15 @@ def render_overview_page(confluence_page_url, overview_name, values_array):
         fixed_value.filename = new_filename
         fixed_values_array.append(fixed_value)
 
-    confluence.remove_all_page_attachments(confluence_page_url)
+    image_checksums = {}
     for value in fixed_values_array:
-        confluence.upload_image_to_confluence(confluence_page_url, value.filename)
+        image_checksums[value.filename] = value.checksum
+    confluence.sync_page_attachments(confluence_page_url, image_checksums)
 
-    page_template = read_file("confluence-templates/overview-page.html")
+    page_template = get_template("confluence-templates/overview-page.html")
 
-    multitable_template = read_file("confluence-templates/multitable.html")
-    multitable_row_template = read_file("confluence-templates/multitable-row.html")
+    multitable_template = get_template("confluence-templates/multitable.html")
+    multitable_row_template = get_template("confluence-templates/multitable-row.html")
 
     overview_table = populate_multitable_template(
         multitable_template,
@@ -80,66 +90,48 @@ def render_overview_page(confluence_page_url, overview_name, values_array):
     print()
 
 
-def write_overview_pages(object_schemas):
-
-    state_diagram_array = []
-    for object_schema in object_schemas:
-        state_diagram_array.append(object_schema.state_diagram)
-
-    render_overview_page(cfg.CONFLUENCE_OVERVIEW_PAGE_URL_STATE_DIAGRAMS, "State Diagrams", state_diagram_array)
-
-    desktop_grid_view_array = []
-    for object_schema in object_schemas:
-        desktop_grid_view_array.append(object_schema.desktop_grid_view_vendor)
-        desktop_grid_view_array.append(object_schema.desktop_grid_view_operations)
-        desktop_grid_view_array.append(object_schema.desktop_grid_view_client)
-
-    render_overview_page(cfg.CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_GRIDS, "Desktop Grids", desktop_grid_view_array)
-
-    desktop_details_view_array = []
-    for object_schema in object_schemas:
-        desktop_details_view_array.append(object_schema.desktop_details_view_vendor)
-        desktop_details_view_array.append(object_schema.desktop_details_view_operations)
-        desktop_details_view_array.append(object_schema.desktop_details_view_client)
-
-    render_overview_page(cfg.CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_DETAILS, "Desktop Details", desktop_details_view_array)
-
-    desktop_infocard_view_array = []
-    for object_schema in object_schemas:
-        desktop_infocard_view_array.append(object_schema.desktop_infocard_view_vendor)
-        desktop_infocard_view_array.append(object_schema.desktop_infocard_view_operations)
-        desktop_infocard_view_array.append(object_schema.desktop_infocard_view_client)
-
-    render_overview_page(cfg.CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_INFO_CARDS, "Desktop Infocard", desktop_infocard_view_array)
-
-    mobile_list_view_array = []
-    for object_schema in object_schemas:
-        mobile_list_view_array.append(object_schema.mobile_list_view_vendor)
-        mobile_list_view_array.append(object_schema.mobile_list_view_operations)
-        mobile_list_view_array.append(object_schema.mobile_list_view_client)
-
-    render_overview_page(cfg.CONFLUENCE_OVERVIEW_PAGE_URL_MOBILE_LIST, "Mobile List", mobile_list_view_array)
-
-    mobile_details_view_array = []
-    for object_schema in object_schemas:
-        mobile_details_view_array.append(object_schema.mobile_details_view_vendor)
-        mobile_details_view_array.append(object_schema.mobile_details_view_operations)
-        mobile_details_view_array.append(object_schema.mobile_details_view_client)
-
-    render_overview_page(cfg.CONFLUENCE_OVERVIEW_PAGE_URL_MOBILE_DETAILS, "Mobile Details", mobile_details_view_array)
-
-    email_notifications_array = []
-    for object_schema in object_schemas:
-        email_notifications_array.extend(object_schema.email_notifications_vendor_array)
-        email_notifications_array.extend(object_schema.email_notifications_operations_array)
-        email_notifications_array.extend(object_schema.email_notifications_client_array)
-
-    render_overview_page(cfg.CONFLUENCE_OVERVIEW_PAGE_URL_EMAILS, "Email Notifications", email_notifications_array)
-
-    desktop_spotlight_array = []
-    for object_schema in object_schemas:
-        desktop_spotlight_array.append(object_schema.desktop_spotlight_vendor)
-        desktop_spotlight_array.append(object_schema.desktop_spotlight_operations)
-        desktop_spotlight_array.append(object_schema.desktop_spotlight_client)
-
-    render_overview_page(cfg.CONFLUENCE_OVERVIEW_PAGE_URL_SPOTLIGHT, "Spotlight", desktop_spotlight_array)
+def get_overview_page_urls():
+    return [
+        cfg.CONFLUENCE_OVERVIEW_PAGE_URL_STATE_DIAGRAMS,
+        cfg.CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_GRIDS,
+        cfg.CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_DETAILS,
+        cfg.CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_INFO_CARDS,
+        cfg.CONFLUENCE_OVERVIEW_PAGE_URL_MOBILE_LIST,
+        cfg.CONFLUENCE_OVERVIEW_PAGE_URL_MOBILE_DETAILS,
+        cfg.CONFLUENCE_OVERVIEW_PAGE_URL_EMAILS,
+        cfg.CONFLUENCE_OVERVIEW_PAGE_URL_SPOTLIGHT,
+    ]
+
+
+def get_overview_pages(object_schemas):
+    """Return the overview pages of the given objects as a list of (confluence_page_url, overview_name, values_array)"""
+
+    def collect(*attribute_names):
+        values_array = []
+        for object_schema in object_schemas:
+            for attribute_name in attribute_names:
+                value = getattr(object_schema, attribute_name)
+                if isinstance(value, list):
+                    values_array.extend(value)
+                else:
+                    values_array.append(value)
+        return values_array
+
+    return [
+        (cfg.CONFLUENCE_OVERVIEW_PAGE_URL_STATE_DIAGRAMS, "State Diagrams",
+            collect('state_diagram')),
+        (cfg.CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_GRIDS, "Desktop Grids",
+            collect('desktop_grid_view_vendor', 'desktop_grid_view_operations', 'desktop_grid_view_client')),
+        (cfg.CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_DETAILS, "Desktop Details",
+            collect('desktop_details_view_vendor', 'desktop_details_view_operations', 'desktop_details_view_client')),
+        (cfg.CONFLUENCE_OVERVIEW_PAGE_URL_DESKTOP_INFO_CARDS, "Desktop Infocard",
+            collect('desktop_infocard_view_vendor', 'desktop_infocard_view_operations', 'desktop_infocard_view_client')),
+        (cfg.CONFLUENCE_OVERVIEW_PAGE_URL_MOBILE_LIST, "Mobile List",
+            collect('mobile_list_view_vendor', 'mobile_list_view_operations', 'mobile_list_view_client')),
+        (cfg.CONFLUENCE_OVERVIEW_PAGE_URL_MOBILE_DETAILS, "Mobile Details",
+            collect('mobile_details_view_vendor', 'mobile_details_view_operations', 'mobile_details_view_client')),
+        (cfg.CONFLUENCE_OVERVIEW_PAGE_URL_EMAILS, "Email Notifications",
+            collect('email_notifications_vendor_array', 'email_notifications_operations_array', 'email_notifications_client_array')),
+        (cfg.CONFLUENCE_OVERVIEW_PAGE_URL_SPOTLIGHT, "Spotlight",
+            collect('desktop_spotlight_vendor', 'desktop_spotlight_operations', 'desktop_spotlight_client')),
+    ]
@@ -1,12 +1,14 @@
-from config import Config
+from config import cfg
 
 from confluence import Confluence
 from schema import SchemaRecord
-from util import populate_template, read_file
+from tracing import tracer
+from util import populate_template
+from templates import get_template
 
-cfg = Config()
 confluence = Confluence()
 
+@tracer.traced('renderers')
 def write_summary_page(object_schemas):
 
     print()
@@ -35,7 +37,7 @@ def write_summary_page(object_schemas):
             return '<p style="text-align: center;"><span style="color: rgb(200,200,200);">—</span></p>'
         return f'<p style="text-align: center;"><strong>{count}</strong></p>'
 
-    summary_table_row_template = read_file("confluence-templates/summary-table-row.html")
+    summary_table_row_template = get_template("confluence-templates/summary-table-row.html")
 
     object_rows = []
 
@@ -78,7 +80,7 @@ def write_summary_page(object_schemas):
         object_row = populate_template(summary_table_row_template, placeholders)
         object_rows.append(object_row)
 
-    summary_page_template = read_file("confluence-templates/summary-page.html")
+    summary_page_template = get_template("confluence-templates/summary-page.html")
     summary_page_template = populate_template(summary_page_template, {
         '{{summary-page-rows}}': '\n'.join(object_rows),
     })
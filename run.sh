@@ -1,7 +1,10 @@
 #!/bin/bash
 
-rm -rf ./build
+# Start from a clean ./build, but keep the persistent caches in ./build/cache between runs
+if [ -d ./build ]; then
+    find ./build -mindepth 1 -maxdepth 1 ! -name cache -exec rm -rf {} +
+fi
 python3 -m venv venv
 source venv/bin/activate
 pip install -r requirements.txt
-python ./main.py
+python ./main.py "$@"
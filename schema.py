@@ -1,13 +1,26 @@
 #! /usr/bin/env python3
 
 import os
-import json
+import threading
 
 from figma import Figma
-from config import Config
+from config import cfg
+from util import file_sha256
+from schema_loader import parse_schema
+from tracing import tracer
 
-cfg = Config()
-figma = Figma()
+_figma = None
+_figma_lock = threading.Lock()
+
+
+def get_figma():
+    """Return the Figma client shared by all schema records, created on first use as it needs the configuration"""
+
+    global _figma
+    with _figma_lock:
+        if _figma is None:
+            _figma = Figma()
+    return _figma
 
 
 class SchemaRecord:
@@ -24,40 +37,52 @@ class SchemaRecord:
         self.filename = None
         self.title = title
         self.status = self.SCHEMA_RECORD_STATUS_ERROR
+        self.checksum = None
 
 
-    def render_figma_image(self, output_folder):
+    def get_image_filename(self, output_folder):
+        """Return the file the image of this record is rendered to, or the placeholder image if it has no Figma link"""
+
+        if self.figma_link is None:
+            return self.parent.image_not_defined
+        return os.path.join(output_folder, self.unique_key.replace('.', '-') + '.png')
 
-        print(f'Rendering Figma image for {self.unique_key} url: {self.figma_link}...')
+
+    def _prepare_render(self, output_folder):
+        """Resolve filename and status for records that need no Figma call, returns True if the record still has to be rendered"""
 
         self.filename = self.parent.image_not_defined
 
         if self.figma_link is None:
             self.status = self.SCHEMA_RECORD_STATUS_NOT_FOUND
             print(f'  Page not found for {self.unique_key} - using {self.filename}')
-            return
+            return False
 
-        try:
-            self.filename = self.unique_key.replace('.', '-') + '.png'
-            self.filename = os.path.join(output_folder, self.filename)
-            if cfg.SKIP_ACTUAL_RENDERING_FOR_DEBUG:
-                if not os.path.exists(self.filename):
-                    self.filename = self.parent.image_not_defined
-                    self.status = self.SCHEMA_RECORD_STATUS_NOT_FOUND
-                else:
-                    self.status = self.SCHEMA_RECORD_STATUS_RENDERED
-                print(f'  DEBUG: Skipping actual rendering - using existing image {self.filename}')
+        self.filename = self.get_image_filename(output_folder)
+        if cfg.SKIP_ACTUAL_RENDERING_FOR_DEBUG:
+            if not os.path.exists(self.filename):
+                self.filename = self.parent.image_not_defined
+                self.status = self.SCHEMA_RECORD_STATUS_NOT_FOUND
             else:
-                figma.render_figma_png(self.figma_link, self.filename)
                 self.status = self.SCHEMA_RECORD_STATUS_RENDERED
-            print(f'  Successfully rendered Figma image for {self.unique_key} - {self.filename}')
+            print(f'  DEBUG: Skipping actual rendering - using existing image {self.filename}')
+            return False
+
+        return True
+
 
-        except Exception as e:
-            print(f'  Error rendering Figma image for {self.unique_key}: {e} - using {self.parent.image_rendering_error}')
+    def _finish_render(self, render_result):
+        """Apply a result of Figma.render_figma_pngs: the image checksum, or the exception raised while rendering"""
+
+        if isinstance(render_result, Exception):
+            print(f'  Error rendering Figma image for {self.unique_key}: {render_result} - using {self.parent.image_rendering_error}')
             self.filename = self.parent.image_rendering_error
             self.status = self.SCHEMA_RECORD_STATUS_ERROR
-        
-        return self.filename
+            return
+
+        self.checksum = render_result
+        self.status = self.SCHEMA_RECORD_STATUS_RENDERED
+        print(f'  Successfully rendered Figma image for {self.unique_key} - {self.filename}')
 
 
     def get_filename(self):
@@ -75,6 +100,7 @@ class SchemaRecord:
         )
         new_record.filename = self.filename
         new_record.status = self.status
+        new_record.checksum = self.checksum
         return new_record
 
 
@@ -82,59 +108,21 @@ class ObjectSchema:
 
     def _create_schema_value(self, unique_key):
 
-        keys = unique_key.split('.')
-        last_key = None
-        last_value = self._object_schema
-        for sub_key in keys:
-            if isinstance(last_value, dict) and sub_key in last_value:
-                last_value = last_value[sub_key]
-                last_key = sub_key
-            else:
-                last_value = None
-                last_key = None
-                break
-
-        # for whatever reason many people specify an empty string for the figma link instead of null
-        if last_value == '':
-            last_value = None
-
-        record = SchemaRecord(self, last_value, unique_key)
+        record = SchemaRecord(self, self._schema['values'][unique_key], unique_key)
         if unique_key in self.all_values:
             raise ValueError(f'Schema value for {unique_key} already exists')
         self.all_values[unique_key] = record
 
-        print(f'Initialized schema record for {unique_key} with figma link: {record.figma_link}')
-
         return record
 
 
     def _create_schema_array(self, unique_key):
 
-        keys = unique_key.split('.')
-        last_value = self._object_schema
-        for sub_key in keys:
-            if isinstance(last_value, dict) and sub_key in last_value:
-                next_value = last_value[sub_key]
-                if not isinstance(next_value, dict):
-                    break
-                
-                last_value = next_value
-                last_key = sub_key
-            else:
-                last_value = None
-                last_key = None
-                break
-
-        if last_value is None:
-            return []
-
         schema_records = []
-
-        for key, value in last_value.items():
+        for key, value in self._schema['arrays'][unique_key]:
             element_name = key.lower().strip().replace(' ', '-')
             full_key = f'{unique_key}.{element_name}'
             record = SchemaRecord(self, value, full_key, key)
-            print(f'Initialized schema record for {full_key} with title: {key} and figma link: {value}')
             if full_key in self.all_values:
                 raise ValueError(f'Schema value for {full_key} already exists')
             self.all_values[full_key] = record
@@ -143,16 +131,22 @@ class ObjectSchema:
         return schema_records
 
 
-    def __init__(self, schema_file):
+    def __init__(self, schema_file, schema=None):
+        """schema is the parsed schema file, see SchemaLoader; the file is parsed (and validated) here if it is not given"""
 
         self.image_rendering_error = os.path.join(os.path.dirname(__file__), 'media', 'image-rendering-error.png')
         self.image_not_defined = os.path.join(os.path.dirname(__file__), 'media', 'image-not-defined.png')
 
-        with open(schema_file, 'r', encoding='utf-8') as f:
-            self._object_schema = json.load(f)
+        self.schema_file = schema_file
+        if schema is None:
+            with open(schema_file, 'r', encoding='utf-8') as f:
+                schema, problems = parse_schema(f.read())
+            if problems:
+                raise ValueError(f'Invalid object schema {schema_file}:\n  ' + '\n  '.join(problems))
+        self._schema = schema
 
-        self.object_name = self._object_schema['name'].title()        
-        self.confluence_page_url = self._object_schema['confluence-page']
+        self.object_name = self._schema['name'].title()
+        self.confluence_page_url = self._schema['confluence-page']
         self.confluence_page_title = 'unknown'
 
         self.all_values = {}
@@ -201,12 +195,57 @@ class ObjectSchema:
         return self.object_name < other.object_name
 
 
-    def render_object_images(self):
+    @tracer.traced('render')
+    def render_object_images(self, known_checksums=None):
 
         print()
         print(f"Rendering Figma images for the object: {self.object_name}...")
 
-        os.makedirs(self.object_render_folder, exist_ok=True)
+        render_figma_images(self.all_values.values(), known_checksums)
+
+
+def _reuse_rendered_image(record, checksum):
+    # the image from the build folder or the render cache, without asking Figma whether it is still up to date
+    if not os.path.exists(record.filename) or file_sha256(record.filename) != checksum:
+        if not get_figma().render_cache.get_by_checksum(checksum, record.filename):
+            return False
+
+    record.checksum = checksum
+    record.status = record.SCHEMA_RECORD_STATUS_RENDERED
+    print(f'  Reusing Figma image for {record.unique_key} - {record.filename}')
+    return True
+
+
+def can_reuse_rendered_image(record, checksum):
+    """Whether _reuse_rendered_image would serve the image of a record with this checksum, without copying it"""
+
+    if get_figma().render_cache.contains_checksum(checksum):
+        return True
+    filename = record.get_image_filename(record.parent.object_render_folder)
+    return os.path.exists(filename) and file_sha256(filename) == checksum
+
+
+@tracer.traced('render')
+def render_figma_images(schema_records, known_checksums=None):
+    """Render the Figma images of many schema records at once, possibly across several objects.
+
+    Records are batched per Figma file, see Figma.render_figma_pngs. Records found in known_checksums
+    (dict unique_key -> checksum of a previous render) reuse that image if it is still on disk or in the render cache."""
+
+    known_checksums = known_checksums or {}
+
+    pending_records = []
+    for record in schema_records:
+        os.makedirs(record.parent.object_render_folder, exist_ok=True)
+        if not record._prepare_render(record.parent.object_render_folder):
+            continue
+        checksum = known_checksums.get(record.unique_key)
+        if checksum is not None and _reuse_rendered_image(record, checksum):
+            continue
+        pending_records.append(record)
+
+    print(f'Rendering {len(pending_records)} Figma images...')
+    render_results = get_figma().render_figma_pngs([(record.figma_link, record.filename) for record in pending_records])
 
-        for value in self.all_values.values():
-            value.render_figma_image(self.object_render_folder)
+    for record in pending_records:
+        record._finish_render(render_results[record.filename])
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+import os
+import re
+import json
+import hashlib
+import math
+
+from figma import parse_figma_url
+from tracing import tracer
+from util import create_process_pool, write_json_atomically
+
+
+# Views of an object, unique key -> path in the schema file; the paths are split once here, not for every schema
+SCHEMA_VALUE_KEYS = [
+    'state-diagram',
+    'desktop.grid.vendor', 'desktop.grid.operations', 'desktop.grid.client',
+    'desktop.details.vendor', 'desktop.details.operations', 'desktop.details.client',
+    'desktop.infocard.vendor', 'desktop.infocard.operations', 'desktop.infocard.client',
+    'desktop.spotlight.vendor', 'desktop.spotlight.operations', 'desktop.spotlight.client',
+    'desktop.settings.vendor', 'desktop.settings.operations', 'desktop.settings.client',
+    'mobile.list.vendor', 'mobile.list.operations', 'mobile.list.client',
+    'mobile.details.vendor', 'mobile.details.operations', 'mobile.details.client',
+]
+SCHEMA_VALUE_PATHS = [(unique_key, unique_key.split('.')) for unique_key in SCHEMA_VALUE_KEYS]
+
+# Lists of titled views (title -> Figma link) of an object
+SCHEMA_ARRAY_KEYS = [
+    'email-notifications.vendor',
+    'email-notifications.operations',
+    'email-notifications.client',
+]
+SCHEMA_ARRAY_PATHS = [(unique_key, unique_key.split('.')) for unique_key in SCHEMA_ARRAY_KEYS]
+
+CONFLUENCE_PAGE_URL_PATTERN = re.compile(r'^https?://[^/]+/.*/pages/\d+(/|$)')
+
+# Parsing a schema takes well under a millisecond, starting a worker process far longer: fewer uncached
+# schemas than this are parsed right away
+SCHEMA_PROCESS_POOL_MIN_FILES = 500
+
+# Bump when parse_schema changes, so schemas parsed by an older version are parsed again
+SCHEMA_CACHE_VERSION = 1
+
+
+def _get_path(data, path):
+    # the value at the path, or None if it is not there; a non-object on the way counts as not there
+    for key in path:
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+
+def _check_figma_link(value, location, problems):
+    # Returns the Figma link of a view, None for views that are not defined
+
+    # for whatever reason many people specify an empty string for the figma link instead of null
+    if value is None or value == '':
+        return None
+    if not isinstance(value, str):
+        problems.append(f'{location}: Figma link must be a string or null')
+        return None
+    try:
+        parse_figma_url(value)
+    except ValueError as e:
+        problems.append(f'{location}: {e}: {value}')
+    return value
+
+
+def parse_schema(text):
+    """Parse and validate the text of an object schema file.
+
+    Returns (schema, problems): schema is {name, confluence-page, values: unique key -> Figma link or None,
+    arrays: unique key -> [[title, Figma link or None]]}, problems lists everything that is wrong with the file."""
+
+    problems = []
+    try:
+        data = json.loads(text)
+    except ValueError as e:
+        return None, [f'not valid JSON: {e}']
+    if not isinstance(data, dict):
+        return None, ['the file must hold a JSON object']
+
+    name = data.get('name')
+    if not isinstance(name, str) or not name.strip():
+        problems.append('name is missing or empty')
+
+    confluence_page_url = data.get('confluence-page')
+    if not isinstance(confluence_page_url, str) or not CONFLUENCE_PAGE_URL_PATTERN.match(confluence_page_url):
+        problems.append(f'confluence-page must be the URL of a Confluence page (.../pages/<id>/...): {confluence_page_url}')
+
+    values = {}
+    for unique_key, path in SCHEMA_VALUE_PATHS:
+        values[unique_key] = _check_figma_link(_get_path(data, path), unique_key, problems)
+
+    arrays = {}
+    for unique_key, path in SCHEMA_ARRAY_PATHS:
+        views = _get_path(data, path)
+        arrays[unique_key] = []
+        if views is None:
+            continue
+        if not isinstance(views, dict):
+            problems.append(f'{unique_key}: must be an object of title -> Figma link')
+            continue
+        element_keys = set()
+        for title, value in views.items():
+            element_key = title.lower().strip().replace(' ', '-')
+            if element_key in element_keys:
+                problems.append(f'{unique_key}: more than one view is named {title}')
+            element_keys.add(element_key)
+            arrays[unique_key].append([title, _check_figma_link(value, f'{unique_key}.{title}', problems)])
+
+    if problems:
+        return None, problems
+    return {'name': name, 'confluence-page': confluence_page_url, 'values': values, 'arrays': arrays}, []
+
+
+class SchemaLoader:
+    """Loads and validates object schema files before anything is rendered or published.
+
+    Files are read and hashed here, parsed schemas are kept in a cache file keyed by the SHA-256 of the schema file,
+    so unchanged schemas are neither parsed nor validated again. Parsing and validation are CPU bound, many uncached
+    schemas are parsed in a pool of max_processes processes. Invalid schemas are all reported at once."""
+
+    def __init__(self, cache_filename, max_processes=None):
+        self.cache_filename = cache_filename
+        self.max_processes = max_processes or os.cpu_count() or 1
+        self.cached_count = 0
+        self._cache = {}
+
+        if os.path.exists(cache_filename):
+            try:
+                with open(cache_filename, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') == SCHEMA_CACHE_VERSION:
+                    self._cache = data['schemas']
+            except (OSError, ValueError, KeyError) as e:
+                print(f'Ignoring unreadable schema cache {cache_filename}: {e}')
+
+
+    def _parse_schemas(self, texts):
+        # Returns the (schema, problems) of every text, see parse_schema
+
+        process_count = min(self.max_processes, len(texts))
+        if process_count < 2 or len(texts) < SCHEMA_PROCESS_POOL_MIN_FILES:
+            return [parse_schema(text) for text in texts]
+
+        print(f'Parsing {len(texts)} object schemas in {process_count} processes...')
+        with create_process_pool(process_count) as executor:
+            return list(executor.map(parse_schema, texts, chunksize=math.ceil(len(texts) / process_count)))
+
+
+    @tracer.traced('schemas')
+    def load(self, schema_files):
+        """Return the parsed schemas of the files as a dict schema file -> schema (see parse_schema),
+        raises ValueError listing the problems of every invalid file"""
+
+        schemas = {}
+        checksums = {}
+        problems = []
+        uncached_texts = {}
+        self.cached_count = 0
+        for schema_file in schema_files:
+            try:
+                with open(schema_file, 'rb') as f:
+                    content = f.read()
+            except OSError as e:
+                problems.append(f'{schema_file}: {e}')
+                continue
+
+            checksum = hashlib.sha256(content).hexdigest()
+            checksums[schema_file] = checksum
+            if checksum in self._cache:
+                schemas[schema_file] = self._cache[checksum]
+                self.cached_count += 1
+                continue
+
+            try:
+                uncached_texts[schema_file] = content.decode('utf-8')
+            except UnicodeDecodeError as e:
+                problems.append(f'{schema_file}: not UTF-8: {e}')
+
+        parsed = self._parse_schemas(list(uncached_texts.values()))
+        for schema_file, (schema, file_problems) in zip(uncached_texts, parsed):
+            if file_problems:
+                problems.extend(f'{schema_file}: {problem}' for problem in file_problems)
+            else:
+                schemas[schema_file] = schema
+
+        if problems:
+            raise ValueError(f'Invalid object schemas ({len(problems)} problems):\n  ' + '\n  '.join(sorted(problems)))
+
+        # only the schemas of this run are kept, the cache does not grow with every edit
+        self._cache = {checksums[schema_file]: schema for schema_file, schema in schemas.items()}
+        self._save()
+        return {schema_file: schemas[schema_file] for schema_file in schema_files}
+
+
+    def _save(self):
+
+        write_json_atomically(self.cache_filename, {'version': SCHEMA_CACHE_VERSION, 'schemas': self._cache})
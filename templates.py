@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import os
+import re
+import threading
+import functools
+
+
+# Placeholders look like {{name}}, they are replaced as a whole including the braces
+PLACEHOLDER_PATTERN = re.compile(r'\{\{(.*?)\}\}')
+
+
+class Template:
+    """A template compiled once into its literal segments and the placeholders (slots) between them.
+
+    Rendering checks the given values against the slots found at compile time and joins segments and values
+    in a single pass, values are inserted as they are (placeholders in values are not replaced)."""
+
+    def __init__(self, text, name='<string>'):
+        self.text = text
+        self.name = name
+
+        self._segments = []
+        self._slots = []
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(text):
+            self._segments.append(text[position:match.start()])
+            self._slots.append(match.group(0))
+            position = match.end()
+        self._segments.append(text[position:])
+
+        if '{{' in ''.join(self._segments):
+            raise ValueError(f"Unterminated placeholder in template {name}")
+        self.slots = frozenset(self._slots)
+
+
+    def render(self, data):
+        """Return the template with every placeholder replaced, data is a dict placeholder ('{{name}}') -> value.
+
+        Every key must be a placeholder of the template and every placeholder must have a value, None becomes 'Undefined'."""
+
+        unknown_keys = [key for key in data if key not in self.slots]
+        if unknown_keys:
+            raise Exception(f"Keys {unknown_keys} not found in template {self.name}")
+        if len(data) != len(self.slots):
+            unmatched_slots = sorted(self.slots.difference(data))
+            raise Exception(f"Unmatched variables found in template {self.name}: {unmatched_slots}")
+
+        values = {key: 'Undefined' if value is None else str(value) for key, value in data.items()}
+        parts = [None] * (2 * len(self._slots) + 1)
+        parts[0::2] = self._segments
+        parts[1::2] = [values[slot] for slot in self._slots]
+        return ''.join(parts)
+
+
+_template_cache = {}
+_template_cache_lock = threading.Lock()
+
+
+def get_template_filename(filename):
+    """Return the path of a template file given relative to this module, whatever the working directory"""
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+
+
+def get_template(filename):
+    """Return the compiled template of a file (relative to this module), compiled once and again only when the file changes"""
+
+    filename = get_template_filename(filename)
+    stat = os.stat(filename)
+    version = (stat.st_mtime_ns, stat.st_size)
+
+    with _template_cache_lock:
+        cached = _template_cache.get(filename)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+    with open(filename, 'r', encoding='utf-8') as f:
+        template = Template(f.read(), os.path.basename(filename))
+
+    with _template_cache_lock:
+        _template_cache[filename] = (version, template)
+    return template
+
+
+@functools.lru_cache(maxsize=64)
+def compile_template(text):
+    """Return the compiled template of a string, the last few are kept"""
+    return Template(text)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from canonical import canonical_digest
+
+
+def test_attribute_order_is_ignored():
+    assert canonical_digest('<p class="a" id="b">x</p>') == canonical_digest('<p id="b" class="a">x</p>')
+
+
+def test_self_closing_tags_equal_empty_elements():
+    assert canonical_digest('<p><ac:image/></p>') == canonical_digest('<p><ac:image></ac:image></p>')
+    assert canonical_digest('<p>a<br/>b</p>') == canonical_digest('<p>a<br>b</p>')
+
+
+def test_stray_end_tags_are_dropped():
+    assert canonical_digest('<p>a</p></div>') == canonical_digest('<p>a</p>')
+
+
+def test_version_at_save_is_ignored():
+    assert canonical_digest('<ri:attachment ri:filename="a.png" ri:version-at-save="3"/>') == \
+        canonical_digest('<ri:attachment ri:filename="a.png" ri:version-at-save="7"/>')
+
+
+def test_ascii_whitespace_is_collapsed():
+    assert canonical_digest('<p>a  b\n\tc</p>') == canonical_digest('<p> a b c </p>')
+
+
+def test_non_breaking_space_is_text():
+    assert canonical_digest('<p>a&nbsp;b</p>') != canonical_digest('<p>a b</p>')
+    assert canonical_digest('<p>a&nbsp;</p>') != canonical_digest('<p>a</p>')
+    assert canonical_digest('<p>a&nbsp;b</p>') == canonical_digest('<p>a\u00a0b</p>')
+
+
+def test_text_and_attribute_values_matter():
+    assert canonical_digest('<p>a</p>') != canonical_digest('<p>b</p>')
+    assert canonical_digest('<p class="a">x</p>') != canonical_digest('<p class="b">x</p>')
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import time
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+def parse_retry_after(value):
+    """Return the number of seconds to wait from a Retry-After header value (seconds or HTTP date), or None"""
+
+    if value is None:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    """Thread-safe token bucket scheduling requests to a rate limited API.
+
+    The rate backs off multiplicatively when the server throttles us and creeps back up towards the
+    configured maximum while requests succeed, so we settle at the highest rate the server tolerates."""
+
+    def __init__(self, max_rate, burst, min_rate=None):
+        self.max_rate = max_rate
+        self.min_rate = min_rate if min_rate is not None else max_rate / 20
+        self.rate = max_rate
+        self.capacity = burst
+
+        self.throttled_count = 0
+        self.retried_count = 0
+
+        self._tokens = burst
+        self._last_refill = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+
+    def acquire(self):
+        """Block until a request may be sent"""
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+
+    def on_throttled(self, wait):
+        """Record a throttled request, halve the rate and hold back all requests for wait seconds"""
+
+        with self._lock:
+            now = time.monotonic()
+            self.throttled_count += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0
+            self._last_refill = now
+            self._paused_until = max(self._paused_until, now + wait)
+
+
+    def on_retry(self):
+        with self._lock:
+            self.retried_count += 1
+
+
+class AdaptiveConcurrencyLimit:
+    """Thread-safe AIMD limit of the requests in flight to a server.
+
+    The limit grows by one per round of healthy responses (fast enough, not throttled) and is halved when
+    the server throttles us (429/503), so we keep as many requests in flight as the server tolerates."""
+
+    def __init__(self, initial_limit, max_limit, latency_target, min_limit=1):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.limit = float(max(min_limit, min(initial_limit, max_limit)))
+
+        self.throttled_count = 0
+        self.request_count = 0
+
+        self._in_flight = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+
+    def acquire(self):
+        """Block until another request may be sent"""
+
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+
+    def release(self, latency, throttled):
+
+        with self._condition:
+            self._in_flight -= 1
+            self.request_count += 1
+
+            now = time.monotonic()
+            if throttled:
+                self.throttled_count += 1
+                # Requests that were already in flight get throttled too, decrease only once per round trip
+                if now - self._last_decrease > latency:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self._last_decrease = now
+            elif latency <= self.latency_target:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self._condition.notify_all()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import inspect
+import functools
+import threading
+import contextlib
+
+from metrics import get_endpoint
+
+
+class Tracer:
+    """Collects spans (name, category, start, duration, thread) of a run and writes them in the Chrome trace
+    event format, to be opened in chrome://tracing or https://ui.perfetto.dev.
+
+    Tracing is off until enable() is called, spans then cost nothing but a flag check."""
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._events = []
+        self._thread_names = {}
+        self._origin = time.monotonic()
+
+
+    def enable(self):
+
+        with self._lock:
+            self.enabled = True
+            self._events = []
+            self._thread_names = {}
+            self._origin = time.monotonic()
+
+
+    def add_span(self, name, category, start, end, thread_id=None, args=None):
+        """Add a span that ran from start to end (time.monotonic) on the given thread (default: the current one)"""
+
+        if not self.enabled:
+            return
+
+        if thread_id is None:
+            thread_id = threading.get_ident()
+            thread_name = threading.current_thread().name
+        else:
+            thread_name = None
+
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': round((start - self._origin) * 1e6),
+            'dur': round((end - start) * 1e6),
+            'pid': os.getpid(),
+            'tid': thread_id,
+        }
+        if args:
+            event['args'] = args
+        with self._lock:
+            self._events.append(event)
+            if thread_name is not None:
+                self._thread_names.setdefault(thread_id, thread_name)
+
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+
+        if not self.enabled:
+            yield
+            return
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_span(name, category, start, time.monotonic(), args=args or None)
+
+
+    def traced(self, category, name=None):
+        """Decorator adding a span for every call of a function"""
+
+        def decorator(function):
+            span_name = name or function.__qualname__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.span(span_name, category):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+    def traced_methods(self, category, exclude=()):
+        """Class decorator adding a span for every call of the public methods of a class, but the excluded ones"""
+
+        def decorator(cls):
+            for attribute_name, attribute in list(vars(cls).items()):
+                if attribute_name.startswith('_') or attribute_name in exclude or not inspect.isfunction(attribute):
+                    continue
+                setattr(cls, attribute_name, self.traced(category)(attribute))
+            return cls
+        return decorator
+
+
+    def instrument_session(self, session, service):
+        """Add a span for every response received by a requests session, from sending it to receiving the headers"""
+
+        def on_response(response, *args, **kwargs):
+            if not self.enabled:
+                return
+            end = time.monotonic()
+            request = response.request
+            self.add_span(
+                get_endpoint(request.method, request.url),
+                service,
+                end - response.elapsed.total_seconds(),
+                end,
+                args={'url': request.url, 'status': response.status_code}
+            )
+        session.hooks['response'].append(on_response)
+
+
+    def write(self, filename):
+
+        with self._lock:
+            events = list(self._events)
+            events.extend(
+                {
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': os.getpid(),
+                    'tid': thread_id,
+                    'args': {'name': thread_name},
+                }
+                for thread_id, thread_name in self._thread_names.items()
+            )
+
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+# Shared by all modules, enabled by main --trace
+tracer = Tracer()
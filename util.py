@@ -1,10 +1,17 @@
 #! /usr/bin/env python3
 
 import os
-import re
+import json
+import shutil
+import hashlib
+import multiprocessing
+import concurrent.futures
 from datetime import datetime
 
+from templates import Template, get_template, compile_template
+
 def populate_multitable_template(multitable_template, multitable_row_template, schema_values_array):
+    # the templates are compiled Templates (see get_template) or template strings
 
     if schema_values_array is None or len(schema_values_array) == 0:
         return '<p>Not defined</p>'
@@ -25,7 +32,7 @@ def populate_multitable_template(multitable_template, multitable_row_template, s
         base_filename = os.path.basename(schema_record.filename)
         return f'<td><ac:image ac:align="center" ac:alt="{base_filename}" ac:custom-width="true" ac:layout="center" ac:original-height="3082" ac:original-width="1888" ac:width="343"><ri:attachment ri:filename="{base_filename}"></ri:attachment></ac:image></td>'
 
-    multitable_rows = ""
+    multitable_rows = []
     for i in range(0, len(schema_values_array), 5):
         block = schema_values_array[i:i+5]
         template_data = {
@@ -41,34 +48,56 @@ def populate_multitable_template(multitable_template, multitable_row_template, s
             '{{cell24}}': get_cell_value(block[3] if len(block) > 3 else None),
             '{{cell25}}': get_cell_value(block[4] if len(block) > 4 else None),
         }
-        multitable_rows += populate_template(multitable_row_template, template_data)
+        multitable_rows.append(populate_template(multitable_row_template, template_data))
 
-    multitable_template = multitable_template.replace('{{multitable-rows}}', multitable_rows)
-    return multitable_template
+    return populate_template(multitable_template, {'{{multitable-rows}}': ''.join(multitable_rows)})
 
 
 def populate_template(template, data):
-    for key, value in data.items():
-        if key not in template:
-            raise Exception(f"Key {key} not found in template")
-        if value is None:
-            value = 'Undefined'
-        template = template.replace(key, str(value))
-
-    unmatched_vars = re.findall(r"\{\{.*?\}\}", template)
-    if unmatched_vars:
-        raise Exception(f"Unmatched variables found in template: {unmatched_vars}")
+    """Replace the placeholders of a template (a compiled Template or a string) with the values in data, see Template.render"""
 
-    return template
+    if not isinstance(template, Template):
+        template = compile_template(template)
+    return template.render(data)
 
 
 def read_file(filename):
-    # Make filename relative to the location of this module
-    module_dir = os.path.dirname(__file__)
-    filename = os.path.join(module_dir, filename)
-    with open(filename, 'r', encoding='utf-8') as f:
-        return f.read()
+    # Relative to the location of this module, the content is only read again when the file changes
+    return get_template(filename).text
 
 
 def get_timestamp():
-    return datetime.now().strftime("%b %d, %Y at %H:%M:%S")
\ No newline at end of file
+    return datetime.now().strftime("%b %d, %Y at %H:%M:%S")
+
+
+def file_sha256(filename):
+    checksum = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def write_file_atomically(filename, text):
+    # readers (and runs interrupted while writing) never see a half written file
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temp_filename, filename)
+
+
+def write_json_atomically(filename, data):
+    write_file_atomically(filename, json.dumps(data))
+
+
+def copy_file_atomically(source_filename, target_filename):
+    # readers of target_filename never see a partial copy
+    temp_filename = target_filename + '.part'
+    shutil.copyfile(source_filename, temp_filename)
+    os.replace(temp_filename, target_filename)
+
+
+def create_process_pool(max_workers=None):
+    # spawn, as forking a process with running threads may copy locks held by those threads
+    return concurrent.futures.ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn'))